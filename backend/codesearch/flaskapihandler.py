@@ -2,6 +2,8 @@ import openai
 import faiss
 import dotenv
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import os
 from os import listdir
 import validators
@@ -9,83 +11,359 @@ import re
 import subprocess
 import random
 import shutil
-import numpy as np
+import hashlib
+import threading
+import functools
+import heapq
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import numpy as np
 
-from .utils.simplecst import SimpleCST
-from .utils.simpletreesitter import SimpleTreeSitter
+from .utils.fileparser import ParallelParser, get_language
+from .utils.simpletreesitter import build_library
+from .utils.indexregistry import IndexRegistry
+from .utils.embeddingprovider import get_embedding_provider
+from .utils.embeddingbatcher import EmbeddingBatcher
+from .utils.ratelimiter import AdaptiveRateLimiter
+from .utils.indexingpipeline import IndexingPipeline
+from .utils.bulkwriter import BulkWriter
+from .utils.embeddingcache import EmbeddingCache
+from .utils.embeddingstorage import EmbeddingStorage
+from .utils.jobmanager import JobManager
+from .utils.readwritelock import ReadWriteLock
+from .utils.querycache import QueryEmbeddingCache, normalize_query
+from .utils.metadatafilter import ProjectMetadata, get_filters
+from .utils.lexicalindex import LexicalIndex, fuse, get_identifiers
+from .utils.filewalker import FileWalker, WalkReport
+from .utils.gitclone import CloneError, CloneTooLargeError, clone_repository
+from .utils.indexfactory import (
+    build_index,
+    get_compression_report,
+    get_index_summary,
+    get_recall_report,
+    get_search_parameters,
+    get_sub_index,
+    is_compressed,
+    rerank,
+)
 
 dotenv.load_dotenv()
 
-openai.organization = os.environ["OPENAI_ORG_ID"]
-openai.api_key = os.environ["OPENAI_API_KEY"]
+# Not needed with local embedding models (model.code_embedding: local:<model directory>)
+openai.organization = os.environ.get("OPENAI_ORG_ID")
+openai.api_key = os.environ.get("OPENAI_API_KEY")
 
 # Threshold for maximum folder size (in bytes). This is set to 100MB
 MAX_SIZE = 100000000
 
+# Files that are parsed and indexed (and the only files checked out of cloned repositories)
+SOURCE_EXTENSIONS = (".py", ".js")
+
+# Columns added after the first version of the tables, see FlaskAPIHandler._migrate_tables
+MAPPING_COLUMNS = [
+    # Projects indexed before the storage column existed use FLOAT[] arrays (NULL storage)
+    ("storage", "TEXT"),
+    ("commit_sha", "TEXT"),
+    # Embedding model and dimension of the project, NULL for projects indexed before (model.dimension)
+    ("model", "TEXT"),
+    ("dimension", "INTEGER"),
+    # Bumped whenever the rows of the embeddings table change, keys the per-project data of _get_index_data
+    ("version", "INTEGER DEFAULT 0"),
+]
+EMBEDDING_COLUMNS = [
+    # Used by handle_reindex to find changed files and functions, NULL for projects indexed before
+    ("content_hash", "TEXT"),
+    ("file_hash", "TEXT"),
+    ("file_mtime", "DOUBLE PRECISION"),
+    # Identifiers for the lexical index
+    ("tokens", "TEXT"),
+]
+
+# Advisory lock serializing the schema migrations of concurrently starting server workers
+SCHEMA_LOCK_ID = 735168
+
+# Retrieval modes of /search and /search/batch, the default is search.default_mode in config.yaml
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+
 ## NOTE:
 # 1.) Library for AST:
 #   - LibCST: Python
 #   - TreeSitter: Javascript
 # 2.) Indexing for libCST starts from 1, and for TreeSitter starts from 0 (accounted for by add 1 in append item)
 # 3.) Write functional code, do not make any state variable that needs to be updated in the flow
+# 4.) Requests and jobs run concurrently. Every handle_* / _run_* method checks a connection out of the pool
+#     (see with_connection), self.conn is the connection of the current thread. Per-project indexes are
+#     guarded by read / write locks: searches read, building or replacing an index writes.
+# 5.) Searches are vector (FAISS), lexical (BM25 over identifiers, names and paths, see LexicalIndex) or
+#     hybrid (both fused by reciprocal rank). Lexical searches never call the embedding provider.
 
 ## TODO:
-# 1.) Add a re-index button, to re-index an already indexed library. Preferably store the SHA of the latest commit
-# 2.) Add a button to delete a repo's embedding table (Only for the self-hosted version)
-# 3.) Add a check that the number of tokens are less than the max allowed by OpenAI, if so then take those many tokens
+# 1.) Add a button to delete a repo's embedding table (Only for the self-hosted version)
+
+
+# Runs the method with a pooled connection checked out for the current thread (nested calls share it)
+def with_connection(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._checkout_connection():
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class FlaskAPIHandler(object):
     def __init__(self, configs):
         self.configs = configs
 
-        # Database
-        self.conn = psycopg2.connect(
-            database=configs["postgres"]["db_name"],
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASSWORD"],
-            host=configs["postgres"]["host"],
-            port=configs["postgres"]["port"],
+        # Database, the semaphore makes a checkout wait for a free connection instead of failing
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            configs["postgres"]["pool_min"],
+            configs["postgres"]["pool_max"],
+            **self._get_connection_params()
         )
-        self._create_mapping_table()
-
-        # FAISS
-        self._create_faiss_index()
-
-    def __del__(self):
-        self.conn.close()
+        self.pool_semaphore = threading.BoundedSemaphore(
+            configs["postgres"]["pool_max"]
+        )
+        self.local = threading.local()
+        self.index_locks = {}
+        self.index_locks_lock = threading.Lock()
+        # (ProjectMetadata / LexicalIndex, table name) -> (table version, object), see _get_index_data
+        self.index_data = {}
+        self.index_data_lock = threading.Lock()
 
-    def _create_faiss_index(self):
-        cpu_index = faiss.IndexFlatIP(self.configs["model"]["dimension"])
+        with self._checkout_connection():
+            self._create_mapping_table()
+            self._migrate_tables()
 
+        # FAISS
         if faiss.get_num_gpus() == 0:
             print("No GPU detected. Using CPU.")
-            self.index = cpu_index
         else:
             print("GPU detected. Using GPU.")
             self.res = faiss.StandardGpuResources()
-            self.index = faiss.index_cpu_to_gpu(
+
+        # Per-project indexes, kept in memory and on disk so that a search does not rebuild them
+        self.index_registry = IndexRegistry(
+            cache_dir=configs["index"]["cache_dir"],
+            max_bytes=configs["index"]["max_cache_bytes"],
+            to_device=self._to_device,
+            mmap=configs["index"]["mmap"],
+        )
+        with self._checkout_connection():
+            self.index_registry.load_all(is_valid=self._check_if_index_valid)
+
+        # Embeddings
+        self.code_embedding_provider = get_embedding_provider(
+            configs=configs, model=configs["model"]["code_embedding"]
+        )
+        self.text_embedding_provider = get_embedding_provider(
+            configs=configs, model=configs["model"]["text_embedding"]
+        )
+        self.embedding_batcher = EmbeddingBatcher(
+            provider=self.code_embedding_provider,
+            max_items=configs["embedding"]["batch_size"],
+            max_tokens=configs["embedding"]["batch_tokens"],
+            max_input_tokens=configs["embedding"]["max_input_tokens"],
+            chars_per_token=configs["embedding"]["chars_per_token"],
+        )
+
+        # Embeddings already computed for any project are reused, keyed by model and input hash
+        if configs["embedding_cache"]["enabled"]:
+            self.embedding_cache = EmbeddingCache(
+                conn=self._connect(),
+                max_bytes=configs["embedding_cache"]["max_bytes"],
+                touch_interval=configs["embedding_cache"]["touch_interval"],
+            )
+        else:
+            self.embedding_cache = None
+
+        # Query embeddings, repeated searches do not call the embedding provider
+        if configs["query_cache"]["enabled"]:
+            self.query_cache = QueryEmbeddingCache(
+                max_entries=configs["query_cache"]["max_entries"],
+                ttl=configs["query_cache"]["ttl"],
+                store=self.embedding_cache
+                if configs["query_cache"]["persist"]
+                else None,
+            )
+        else:
+            self.query_cache = None
+
+        # Parsing, the tree-sitter grammars are compiled once here instead of in every parser process
+        build_library()
+        self.parallel_parser = ParallelParser(
+            num_workers=configs["parsing"]["num_workers"],
+            timeout=configs["parsing"]["timeout"],
+            max_file_bytes=configs["parsing"]["max_file_bytes"],
+            python_backend=configs["parsing"]["python_backend"],
+        )
+
+        # Source files of a project, ignored / vendored directories are pruned before they are walked
+        self.file_walker = FileWalker(
+            extensions=SOURCE_EXTENSIONS,
+            exclude=configs["walker"]["exclude"],
+            include=configs["walker"]["include"],
+            gitignore=configs["walker"]["gitignore"],
+            max_file_bytes=configs["parsing"]["max_file_bytes"],
+            max_line_length=configs["walker"]["max_line_length"],
+        )
+
+        # Indexing, the rate limiter is shared by the indexing runs of this process. Every server worker
+        # (see gunicorn.conf.py) has its own, so the quota is split between them: concurrent runs in
+        # different workers together stay within indexing.requests_per_minute / tokens_per_minute.
+        num_server_workers = configs["server"]["workers"]
+        self.rate_limiter = AdaptiveRateLimiter(
+            requests_per_minute=configs["indexing"]["requests_per_minute"]
+            / num_server_workers,
+            tokens_per_minute=configs["indexing"]["tokens_per_minute"]
+            / num_server_workers,
+        )
+        self.indexing_pipeline = IndexingPipeline(
+            batcher=self.embedding_batcher,
+            rate_limiter=self.rate_limiter,
+            num_workers=configs["indexing"]["num_workers"],
+            queue_size=configs["indexing"]["queue_size"],
+            max_retries=configs["indexing"]["max_retries"],
+            backoff_base=configs["indexing"]["backoff_base"],
+            backoff_cap=configs["indexing"]["backoff_cap"],
+            cache=self.embedding_cache,
+        )
+
+        # Shards (per-project indexes) of a global search are searched in parallel
+        self.shard_executor = ThreadPoolExecutor(
+            max_workers=configs["search"]["shard_workers"],
+            thread_name_prefix="shard",
+        )
+        # Indexes missing for a global search are built one at a time, outside of the requests
+        self.index_build_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="index_build"
+        )
+        self.index_builds = set()
+        self.index_builds_lock = threading.Lock()
+
+        # Encode / re-index run as background jobs, so requests never wait for a whole indexing run
+        self.job_manager = JobManager(
+            conn=self._connect(),
+            num_workers=configs["jobs"]["num_workers"],
+            progress_interval=configs["jobs"]["progress_interval"],
+        )
+
+    def __del__(self):
+        self.pool.closeall()
+
+    def _get_connection_params(self):
+        return {
+            "database": self.configs["postgres"]["db_name"],
+            "user": os.environ["POSTGRES_USER"],
+            "password": os.environ["POSTGRES_PASSWORD"],
+            "host": self.configs["postgres"]["host"],
+            "port": self.configs["postgres"]["port"],
+        }
+
+    # Dedicated connection, outside of the pool
+    def _connect(self):
+        return psycopg2.connect(**self._get_connection_params())
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        assert conn is not None, "No connection checked out for this thread"
+
+        return conn
+
+    @contextmanager
+    def _checkout_connection(self):
+        if getattr(self.local, "conn", None) is not None:
+            yield self.local.conn
+            return
+
+        self.pool_semaphore.acquire()
+
+        # A failed connect (e.g. while Postgres restarts) must give the permit back, or the worker runs out
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.pool_semaphore.release()
+            raise
+
+        self.local.conn = conn
+
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+
+            # Never hand a connection with an open (or failed) transaction to the next request
+            close = conn.closed != 0
+            if not close:
+                try:
+                    conn.rollback()
+                except Exception as e:
+                    print("Error in FlaskAPIHandler._checkout_connection: ", e)
+                    close = True
+
+            self.pool.putconn(conn, close=close)
+            self.pool_semaphore.release()
+
+    def _get_index_lock(self, table_name):
+        with self.index_locks_lock:
+            return self.index_locks.setdefault(str(table_name), ReadWriteLock())
+
+    def _to_device(self, cpu_index):
+        if faiss.get_num_gpus() == 0:
+            return cpu_index
+
+        try:
+            return faiss.index_cpu_to_gpu(
                 self.res, 0, cpu_index
             )  # Currently only supports one GPU
+        except Exception as e:
+            # e.g. HNSW has no GPU implementation
+            print("Error in FlaskAPIHandler._to_device, keeping index on CPU: ", e)
+            return cpu_index
 
     def _create_embedding_table(self, table_name):
+        storage = self._get_embedding_storage(table_name=table_name)
+
         cur = self.conn.cursor()
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS embeddings_{} (
                 id SERIAL PRIMARY KEY,
-                embedding FLOAT[{}],
+                {} {},
                 function_name TEXT,
                 class_name TEXT,
                 filepath TEXT,
-                line_number INT
+                line_number INT,
+                {}
             );
             """.format(
-                table_name, self.configs["model"]["dimension"]
+                table_name,
+                storage.get_column_name(),
+                storage.get_column_type(),
+                ", ".join(
+                    "{} {}".format(column, column_type)
+                    for column, column_type in EMBEDDING_COLUMNS
+                ),
             )
         )
         self.conn.commit()
+        self._migrate_embedding_tables(table_names=[table_name])
+
+    # Columns written for every function, in the order of the rows built in _encode_from_path
+    def _get_embedding_columns(self, storage):
+        return [
+            storage.get_column_name(),
+            "function_name",
+            "class_name",
+            "filepath",
+            "line_number",
+            "content_hash",
+            "file_hash",
+            "file_mtime",
+            "tokens",
+        ]
 
     def _create_mapping_table(self):
         cur = self.conn.cursor()
@@ -100,32 +378,149 @@ class FlaskAPIHandler(object):
         )
         self.conn.commit()
 
-    def _update_embedding_table(
-        self, embedding, function_name, class_name, filepath, line_number, table_name
-    ):
+    # Existing columns of the given tables, {table name: set of column names} (catalog read, no locks)
+    def _get_table_columns(self, table_names):
         cur = self.conn.cursor()
-        try:
-            cur.execute(
-                """
-                INSERT INTO embeddings_{} (embedding, function_name, class_name, filepath, line_number)
-                VALUES (%s, %s, %s, %s, %s);
-                """.format(
-                    table_name
-                ),
-                (embedding, function_name, class_name, filepath, line_number),
-            )
-            self.conn.commit()
+        cur.execute(
+            """
+            SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = ANY(%s);
+            """,
+            (list(table_names),),
+        )
 
-        except Exception as e:
-            print("Error in FlaskAPIHandler._update_embedding_table: ", e)
+        columns = {}
+        for table_name, column_name in cur.fetchall():
+            columns.setdefault(table_name, set()).add(column_name)
+
+        return columns
+
+    # Adds the missing EMBEDDING_COLUMNS and the filepath index to existing embeddings tables
+    def _migrate_embedding_tables(self, table_names):
+        cur = self.conn.cursor()
+        cur.execute("""SELECT pg_advisory_xact_lock(%s)""", (SCHEMA_LOCK_ID,))
+
+        tables = ["embeddings_{}".format(table_name) for table_name in table_names]
+        columns = self._get_table_columns(tables)
+        cur.execute(
+            """SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = ANY(%s)""",
+            (tables,),
+        )
+        indexes = set(row[0] for row in cur.fetchall())
+
+        for table in tables:
+            if table not in columns:
+                continue
+
+            for column, column_type in EMBEDDING_COLUMNS:
+                if column not in columns[table]:
+                    cur.execute(
+                        "ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}".format(
+                            table, column, column_type
+                        )
+                    )
+            if "{}_filepath".format(table) not in indexes:
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS {0}_filepath ON {0} (filepath)".format(
+                        table
+                    )
+                )
+
+        self.conn.commit()
+
+    # One-time schema migration at server startup, the request paths (searches in particular) never change
+    # the schema. Only missing columns are added, so an up to date database takes no ACCESS EXCLUSIVE lock.
+    # Workers starting together migrate one after the other (SCHEMA_LOCK_ID).
+    def _migrate_tables(self):
+        cur = self.conn.cursor()
+        cur.execute("""SELECT pg_advisory_xact_lock(%s)""", (SCHEMA_LOCK_ID,))
+        columns = self._get_table_columns(["mapping"]).get("mapping", set())
+
+        for column, column_type in MAPPING_COLUMNS:
+            if column not in columns:
+                cur.execute(
+                    "ALTER TABLE mapping ADD COLUMN IF NOT EXISTS {} {}".format(
+                        column, column_type
+                    )
+                )
+        self.conn.commit()
+
+        cur.execute("""SELECT id FROM mapping""")
+        self._migrate_embedding_tables(table_names=[row[0] for row in cur.fetchall()])
+
+    def _get_commit_sha(self, table_name):
+        cur = self.conn.cursor()
+        cur.execute("""SELECT commit_sha FROM mapping WHERE id = %s""", (table_name,))
+        rows = cur.fetchall()
+
+        return rows[0][0] if rows else None
+
+    # Called once the rows of the project are written, so the table version is bumped along with it
+    def _update_commit_sha(self, table_name, commit_sha):
+        cur = self.conn.cursor()
+        cur.execute(
+            """UPDATE mapping SET commit_sha = %s WHERE id = %s""",
+            (commit_sha, table_name),
+        )
+        self._bump_table_version(table_name=table_name)
+        self.conn.commit()
+
+    # Version of the project's rows (mapping.version), None for a deleted project
+    def _get_table_version(self, table_name):
+        cur = self.conn.cursor()
+        cur.execute("""SELECT version FROM mapping WHERE id = %s""", (table_name,))
+        rows = cur.fetchall()
+
+        return rows[0][0] if rows else None
+
+    # Part of the caller's transaction, the per-project data cached by every server worker is reloaded
+    def _bump_table_version(self, table_name):
+        cur = self.conn.cursor()
+        cur.execute(
+            """UPDATE mapping SET version = COALESCE(version, 0) + 1 WHERE id = %s""",
+            (table_name,),
+        )
+
+    # Embedding model of the project, None for projects indexed before the model was recorded
+    def _get_embedding_model(self, table_name):
+        cur = self.conn.cursor()
+        cur.execute("""SELECT model FROM mapping WHERE id = %s""", (table_name,))
+        rows = cur.fetchall()
+
+        return rows[0][0] if rows else None
+
+    def _get_embedding_storage(self, table_name):
+        cur = self.conn.cursor()
+        cur.execute(
+            """SELECT storage, dimension FROM mapping WHERE id = %s""", (table_name,)
+        )
+        rows = cur.fetchall()
+        storage = rows[0][0] if rows and rows[0][0] is not None else "array"
+        dimension = (
+            rows[0][1]
+            if rows and rows[0][1] is not None
+            else self.configs["model"]["dimension"]
+        )
+
+        return EmbeddingStorage(
+            storage=storage,
+            dimension=dimension,
+            data_dir=self.configs["embedding"]["data_dir"],
+        )
 
     def _update_mapping_table(self, url, is_public):
         cur = self.conn.cursor()
         try:
             cur.execute(
                 """
-            INSERT INTO mapping (url, is_public) VALUES (%s, %s);""",
-                (str(url), is_public),
+            INSERT INTO mapping (url, is_public, storage, model, dimension) VALUES (%s, %s, %s, %s, %s);""",
+                (
+                    str(url),
+                    is_public,
+                    self.configs["embedding"]["storage"],
+                    self.code_embedding_provider.model,
+                    self.code_embedding_provider.dimension,
+                ),
             )
         except Exception as e:
             print("Error in FlaskAPIHandler._update_mapping_table: ", e)
@@ -137,35 +532,270 @@ class FlaskAPIHandler(object):
 
         return id
 
-    def _get_embedding_table(self, table_name):
+    # Metadata of the given rows (no vectors), keyed by id
+    def _get_function_metadata(self, ids, table_name):
         cur = self.conn.cursor()
-        cur.execute("""SELECT * FROM embeddings_{};""".format(table_name))
-        return cur.fetchall()
+        cur.execute(
+            """
+            SELECT id, function_name, class_name, filepath, line_number
+            FROM embeddings_{} WHERE id = ANY(%s);
+            """.format(
+                table_name
+            ),
+            (ids,),
+        )
+
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+    # Per-project data loaded from the embeddings table with cls.load (ProjectMetadata, LexicalIndex).
+    # It is cached by table version and reloaded once the rows changed, it never needs the FAISS index.
+    # version is the project's mapping.version when the caller already read it.
+    def _get_index_data(self, cls, table_name, version=None):
+        key = (cls, str(table_name))
+
+        with self.index_data_lock:
+            entry = self.index_data.get(key)
+
+        with self._checkout_connection():
+            if version is None:
+                version = self._get_table_version(table_name=table_name)
+
+            if entry is not None and entry[0] == version:
+                return entry[1]
+
+            # Read before the rows: a change committed meanwhile bumps the version, the next call reloads
+            data = cls.load(conn=self.conn, table_name=table_name)
+
+        with self.index_data_lock:
+            self.index_data[key] = (version, data)
+
+        return data
+
+    def _drop_index_data(self, table_name):
+        with self.index_data_lock:
+            for key in list(self.index_data):
+                if key[1] == str(table_name):
+                    del self.index_data[key]
+
+    # Returns the (scores, ids) matrices of index.search, under the project's index lock.
+    # filters (see metadatafilter) restrict the search to the matching rows.
+    def _search_index(
+        self,
+        index,
+        table_name,
+        query_embeddings,
+        k,
+        nprobe=None,
+        ef_search=None,
+        filters=None,
+        metadata=None,
+        rerank=True,
+    ):
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype="float32")
+        selector, bitmap = None, None
+
+        if filters:
+            if metadata is None:
+                metadata = self._get_index_data(
+                    cls=ProjectMetadata, table_name=table_name
+                )
+            ids = metadata.get_ids(filters)
+
+            if len(ids) == 0:
+                return (
+                    np.full((len(query_embeddings), k), -np.inf, dtype="float32"),
+                    np.full((len(query_embeddings), k), -1, dtype="int64"),
+                )
 
-    # This function currently only supports single query.
-    def _get_nearest_neighbors(self, query_embedding, table_name):
-        embedding_table = self._get_embedding_table(table_name=table_name)
+            # bitmap is referenced by the selector, it has to live until the search is done
+            selector, bitmap = metadata.get_selector(ids)
 
-        D, I = self.index.search(
-            np.expand_dims(query_embedding, axis=0).astype("float32"),
-            self.configs["model"]["num_nearest_neighbours"],
+        index_lock = self._get_index_lock(table_name)
+
+        # Compressed indexes only return candidates, they are re-ranked with the full vectors
+        # (by the caller with rerank=False, see handle_global_search)
+        is_reranked = self._is_reranked(index)
+        search_k = (
+            k * self.configs["index"]["compression"]["rerank_factor"]
+            if is_reranked
+            else k
         )
 
-        nearest_neighbors = []
-        for i in I[0]:
-            nearest_neighbors.append(embedding_table[i])
+        # GPU indexes do not support concurrent searches
+        with index_lock.read() if faiss.get_num_gpus() == 0 else index_lock.write():
+            D, I = index.search(
+                query_embeddings,
+                search_k,
+                params=get_search_parameters(
+                    index=index,
+                    index_configs=self.configs["index"],
+                    nprobe=nprobe,
+                    ef_search=ef_search,
+                    sel=selector,
+                ),
+            )
 
-        result_dict = {}
+        if is_reranked and rerank:
+            D, I = self._rerank(
+                table_name=table_name,
+                query_embeddings=query_embeddings,
+                candidate_ids=I,
+                k=k,
+            )
 
-        for i, result in enumerate(nearest_neighbors):
-            result_dict["{}".format(i)] = {
-                "function_name": result[2],
-                "class_name": result[3],
-                "filepath": result[4],
-                "line_number": result[5],
-            }
+        return D, I
 
-        return result_dict
+    def _is_reranked(self, index):
+        return self.configs["index"]["compression"]["rerank"] and is_compressed(index)
+
+    # Exact scores of the candidates of a compressed index, from the vectors stored in the embeddings table
+    def _rerank(self, table_name, query_embeddings, candidate_ids, k):
+        with self._checkout_connection():
+            storage = self._get_embedding_storage(table_name=table_name)
+            ids, vectors = storage.load_ids(
+                conn=self.conn,
+                table_name=table_name,
+                ids=np.unique(candidate_ids[candidate_ids >= 0]),
+            )
+
+        return rerank(
+            query_embeddings=query_embeddings,
+            candidate_ids=candidate_ids,
+            ids=ids,
+            vectors=vectors,
+            k=k,
+        )
+
+    def _get_nearest_neighbors(
+        self,
+        query_embedding,
+        table_name,
+        nprobe=None,
+        ef_search=None,
+        filters=None,
+        query=None,
+        mode="vector",
+    ):
+        return self._get_batch_nearest_neighbors(
+            query_embeddings=None
+            if query_embedding is None
+            else np.expand_dims(query_embedding, axis=0),
+            table_name=table_name,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            filters=filters,
+            queries=[query],
+            mode=mode,
+        )[0]
+
+    # Ranked ids of every query with the BM25 index of the project (filters apply as in _search_index)
+    def _get_lexical_neighbors(self, queries, table_name, k, filters=None):
+        version = self._get_table_version(table_name=table_name)
+        lexical_index = self._get_index_data(
+            cls=LexicalIndex, table_name=table_name, version=version
+        )
+        allowed_ids = None
+
+        if filters:
+            allowed_ids = self._get_index_data(
+                cls=ProjectMetadata, table_name=table_name, version=version
+            ).get_ids(filters)
+
+        return [
+            lexical_index.search(query=query, k=k, allowed_ids=allowed_ids)
+            for query in queries
+        ]
+
+    # query_embeddings is a (n, d) matrix, searched with a single index.search call.
+    # Returns one result dict per query. Modes:
+    #   vector: FAISS only
+    #   lexical: BM25 only, queries are used and query_embeddings may be None (no embedding needed)
+    #   hybrid: the top search.hybrid_candidates of both, fused by reciprocal rank
+    def _get_batch_nearest_neighbors(
+        self,
+        query_embeddings,
+        table_name,
+        nprobe=None,
+        ef_search=None,
+        filters=None,
+        queries=None,
+        mode="vector",
+    ):
+        k = self.configs["model"]["num_nearest_neighbours"]
+
+        if mode != "lexical":
+            index = self._get_index(table_name=table_name)
+
+            # Projects embedded with another model (model.code_embedding changed since they were encoded)
+            # can only be searched lexically until they are encoded again
+            if index.d != query_embeddings.shape[1]:
+                print(
+                    "Error in FlaskAPIHandler._get_batch_nearest_neighbors: query dimension {} does not "
+                    "match the index dimension {}, searching lexically".format(
+                        query_embeddings.shape[1], index.d
+                    )
+                )
+                mode = "lexical"
+
+        num_candidates = (
+            k if mode == "vector" else self.configs["search"]["hybrid_candidates"]
+        )
+
+        if mode != "lexical":
+            D, I = self._search_index(
+                index=index,
+                table_name=table_name,
+                query_embeddings=query_embeddings,
+                k=num_candidates,
+                nprobe=nprobe,
+                ef_search=ef_search,
+                filters=filters,
+            )
+
+            # -1 is returned when there are fewer than num_nearest_neighbours functions in the project
+            vector_ids = [[int(id) for id in row if id >= 0] for row in I]
+
+        if mode != "vector":
+            lexical_ids = self._get_lexical_neighbors(
+                queries=queries,
+                table_name=table_name,
+                k=num_candidates,
+                filters=filters,
+            )
+
+        if mode == "vector":
+            ids = vector_ids
+        elif mode == "lexical":
+            ids = [row[:k] for row in lexical_ids]
+        else:
+            ids = [
+                fuse([vector_row, lexical_row], k=self.configs["search"]["rrf_k"])[:k]
+                for vector_row, lexical_row in zip(vector_ids, lexical_ids)
+            ]
+
+        # The metadata of every query is fetched at once
+        metadata = self._get_function_metadata(
+            ids=sorted(set(id for row in ids for id in row)), table_name=table_name
+        )
+
+        result_dicts = []
+
+        for row in ids:
+            result_dict = {}
+
+            # Rows deleted after the index (or the lexical index) of this search was loaded are left out
+            for i, id in enumerate(id for id in row if id in metadata):
+                result = metadata[id]
+                result_dict["{}".format(i)] = {
+                    "function_name": result[0],
+                    "class_name": result[1],
+                    "filepath": result[2],
+                    "line_number": result[3],
+                }
+
+            result_dicts.append(result_dict)
+
+        return result_dicts
 
     # TODO: Add support for other languages. Currently only supports Python, Javascript.
     def _generate_encoding_string(
@@ -182,37 +812,72 @@ class FlaskAPIHandler(object):
 
         return encoding_string
 
-    def _parse_file(self, filepath):
-        # Using LibCST
-        if filepath.endswith(".py"):
-            simple_cst = SimpleCST()
-            simple_cst.set_module(filepath=filepath)
+    # Builds and persists the project's index, replacing the current one
+    def _generate_index(self, table_name, removed_ids=()):
+        with self._get_index_lock(table_name).write():
+            return self._build_index(table_name=table_name, removed_ids=removed_ids)
+
+    # The index maps vectors to the ids of the embeddings table rows, search returns those ids directly.
+    # removed_ids are rows about to be deleted (see _reindex_from_path), they are left out of the index.
+    # Callers hold the project's write lock.
+    def _build_index(self, table_name, removed_ids=()):
+        storage = self._get_embedding_storage(table_name=table_name)
+
+        ids, embedding_np = storage.load(conn=self.conn, table_name=table_name)
+        if len(removed_ids) > 0:
+            keep = ~np.isin(ids, np.array(removed_ids, dtype="int64"))
+            ids, embedding_np = ids[keep], embedding_np[keep]
+        print("embedding_np: ", embedding_np.dtype, " ", embedding_np.shape)
 
-            _ = simple_cst.wrapper.visit(simple_cst)
+        index = self._to_device(
+            build_index(
+                embeddings=embedding_np,
+                ids=ids,
+                dimension=storage.dimension,
+                index_configs=self.configs["index"],
+            )
+        )
 
-            return simple_cst.func_list
+        print("Index size: ", index.ntotal)
+        self.index_registry.put(table_name, index)
 
-        # Using TreeSitter
-        elif filepath.endswith(".js"):
-            sts = SimpleTreeSitter()
-            sts.set_language("javascript")
-            sts.set_module(path=filepath)
-            sts.traverse_tree(sts.module.root_node)
+        return index
 
-            return sts.func_list
+    # Returns the cached index of a project, building (and persisting) it only on a cache miss
+    def _get_index(self, table_name):
+        index = self.index_registry.get(table_name)
 
-    def _generate_index(self, table_name):
-        embedding_table = self._get_embedding_table(table_name=table_name)
+        if index is None:
+            with self._get_index_lock(table_name).write():
+                # Concurrent searches on a cold project wait for one build instead of each building it
+                index = self.index_registry.get(table_name)
 
-        if embedding_table == []:
-            return
+                if index is None:
+                    index = self._build_index(table_name=table_name)
 
-        embedding_np = np.vstack(
-            np.asarray(embedding_table, dtype=object)[:, 1]
-        ).astype("float32")
-        print("embedding_np: ", embedding_np.dtype, " ", embedding_np.shape)
-        self.index.add(embedding_np)
-        print("Index size: ", self.index.ntotal)
+        return index
+
+    # Used on startup to drop persisted indexes of deleted projects or of tables changed outside this handler
+    def _check_if_index_valid(self, table_name, index):
+        # Indexes persisted before they carried row ids
+        if not isinstance(index, faiss.IndexIDMap2):
+            return False
+
+        # Flat pq indexes built as IndexPQ, which can not run filtered searches (see indexfactory)
+        if isinstance(get_sub_index(index), faiss.IndexPQ):
+            return False
+
+        cur = self.conn.cursor()
+
+        try:
+            cur.execute("""SELECT COUNT(*) FROM embeddings_{};""".format(table_name))
+            count = cur.fetchall()[0][0]
+        except Exception as e:
+            print("Error in FlaskAPIHandler._check_if_index_valid: ", e)
+            self.conn.rollback()
+            return False
+
+        return count == index.ntotal
 
     def _reset_database(self, table_name):
         try:
@@ -260,202 +925,954 @@ class FlaskAPIHandler(object):
             )
             raise Exception("There are multiple entries in the DB for this Github URL")
 
-    def _get_folder_size(self, folder):
-        total_size = 0
-        for path, dirs, files in os.walk(folder):
-            for f in files:
-                fp = os.path.join(path, f)
-                if os.path.exists(fp):
-                    total_size += os.path.getsize(fp)
-        return total_size
-
-    # TODO: Put try except in git clone
+    # Shallow clone of the source files only, bounded by MAX_SIZE (see gitclone.clone_repository).
+    # Runs on the job pool, never on a request thread.
+    # Return Flag:
+    #   0: Cloned, the project path is returned with the flag
+    #   1: Repository larger than MAX_SIZE
+    #   2: Clone failed (unknown or private repository, network error, timeout)
     def _clone_repo(self, url):
         project_folder_name = random.randint(10000, 99999)
         project_path = os.path.join("/app/gitrepos", str(project_folder_name))
 
         while os.path.isdir(project_path):
             project_folder_name = random.randint(10000, 99999)
-            project_path = os.path.join("/app/gitrepos", project_folder_name)
+            project_path = os.path.join("/app/gitrepos", str(project_folder_name))
 
-        os.makedirs(project_path)
-        git_process = subprocess.Popen(["git", "clone", url, project_path])
+        os.makedirs("/app/gitrepos", exist_ok=True)
 
-        # Periodically check folder size
-        while git_process.poll() is None:
-            folder_size = self._get_folder_size(project_path)
-            if folder_size > MAX_SIZE:
-                git_process.terminate()
-                print(
-                    "Error: Git clone process terminated, folder size exceeded threshold."
-                )
-                shutil.rmtree(project_path)
-                return False, ""
+        try:
+            stats = clone_repository(
+                url=url,
+                project_path=project_path,
+                max_bytes=MAX_SIZE,
+                max_blob_bytes=self.configs["parsing"]["max_file_bytes"],
+                extensions=SOURCE_EXTENSIONS,
+                timeout=self.configs["clone"]["timeout"],
+            )
+        except CloneTooLargeError as e:
+            print("Error in FlaskAPIHandler._clone_repo: ", e)
+            return 1, ""
+        except CloneError as e:
+            print("Error in FlaskAPIHandler._clone_repo: ", e)
+            return 2, ""
+
+        print("Cloned {}: {}".format(url, stats))
 
-        return True, project_path
+        return 0, project_path
 
     def _get_embedding_from_input(self, input):
-        response = openai.Embedding.create(
-            input=input,
-            model=self.configs["model"]["code_embedding"],
+        embedding = self._get_embeddings_from_inputs(inputs=[input])[0]
+
+        return embedding
+
+    # At most one provider call for all the inputs (none when they are all cached), returns a (n, d) matrix
+    # Queries are normalized on both paths, so enabling the query cache does not change the results
+    def _get_embeddings_from_inputs(self, inputs):
+        queries = [normalize_query(input) for input in inputs]
+
+        if self.query_cache is None:
+            return self.text_embedding_provider.embed(queries)
+
+        model = self.text_embedding_provider.model
+        embeddings = self.query_cache.get_many(model, queries)
+        missing = sorted(set(query for query in queries if query not in embeddings))
+
+        if missing:
+            new_embeddings = dict(
+                zip(missing, self.text_embedding_provider.embed(missing))
+            )
+            self.query_cache.put_many(model, new_embeddings)
+            embeddings.update(new_embeddings)
+
+        return np.stack([embeddings[query] for query in queries])
+
+    # Yields the files to index (see FileWalker), the skipped files are counted in stats
+    def _get_source_files(self, project_path, stats=None):
+        report = WalkReport(stats=stats)
+        yield from self.file_walker.walk(project_path, report=report)
+
+        print("FileWalker: ", report)
+        if stats is not None:
+            stats.skipped = report.to_dict()
+
+    def _get_stored_filepath(self, file_path, is_public):
+        # This is to remove unnecessary path from the filepath
+        return file_path[20 if is_public else 4 :]
+
+    def _get_content_hash(self, content):
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def _get_file_hash(self, file_path):
+        with open(file_path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    # Returns the HEAD commit of the project, None if it is not a git repository
+    def _get_head_sha(self, project_path):
+        try:
+            output = subprocess.run(
+                ["git", "-C", project_path, "rev-parse", "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        except Exception:
+            return None
+
+        return output.stdout.strip()
+
+    # Yields (row, encoding string) for every function in the given files, row holds the embeddings table columns.
+    # Files are parsed in parallel, so functions of different files are interleaved (with parsing.num_workers = 0
+    # they are parsed inline and streamed one function at a time).
+    def _generate_functions(self, file_paths, is_public, stats=None):
+        for file_path, func_list in self.parallel_parser.parse_files(file_paths):
+            if stats is not None:
+                stats.add("files_parsed", 1)
+
+            language = get_language(file_path)
+            file_hash = self._get_file_hash(file_path)
+            file_mtime = os.path.getmtime(file_path)
+
+            for func in func_list:
+                encode_string = self._generate_encoding_string(
+                    language=language,
+                    function_def=func["source"],
+                    function_name=func["func_name"],
+                    class_name=func["class_name"],
+                )
+
+                row = {
+                    "function_name": func["func_name"],
+                    "class_name": func["class_name"],
+                    "filepath": self._get_stored_filepath(file_path, is_public),
+                    "line_number": func["line_number"],
+                    "content_hash": self._get_content_hash(encode_string),
+                    "file_hash": file_hash,
+                    "file_mtime": file_mtime,
+                    # Identifiers of the source for the lexical index
+                    "tokens": " ".join(get_identifiers(func["source"])),
+                }
+
+                yield row, encode_string
+
+    # Embeds and writes the functions of the given rows, returns the BulkWriter (raises on failure,
+    # batches committed before the failure are left for the caller to clean up)
+    def _write_functions(self, functions, table_name, stats=None):
+        storage = self._get_embedding_storage(table_name=table_name)
+        appender = storage.open_appender(table_name=table_name)
+        writer = BulkWriter(
+            conn=self.conn,
+            table="embeddings_{}".format(table_name),
+            columns=self._get_embedding_columns(storage),
+            batch_size=self.configs["indexing"]["write_batch_size"],
+            before_commit=appender.flush if appender is not None else None,
         )
 
-        embedding = np.array(response["data"][0]["embedding"])
+        def write(results):
+            for row, embedding in results:
+                writer.add(
+                    (
+                        storage.encode(embedding=embedding, appender=appender),
+                        row["function_name"],
+                        row["class_name"],
+                        row["filepath"],
+                        row["line_number"],
+                        row["content_hash"],
+                        row["file_hash"],
+                        row["file_mtime"],
+                        row["tokens"],
+                    )
+                )
 
-        return embedding
+        try:
+            self.indexing_pipeline.run(items=functions, write=write, stats=stats)
+            writer.flush()
+        finally:
+            if appender is not None:
+                appender.close()
+
+        print("BulkWriter: ", writer)
+        if self.embedding_cache is not None:
+            print("EmbeddingCache: ", self.embedding_cache)
+
+        return writer
+
+    # Returns True on success. On failure the partially written project is deleted, so that a later
+    # request re-encodes it from scratch instead of serving a half-written table.
+    def _encode_from_path(self, project_path, table_name, is_public, url, stats=None):
+        functions = self._generate_functions(
+            file_paths=self._get_source_files(project_path, stats=stats),
+            is_public=is_public,
+            stats=stats,
+        )
+
+        try:
+            self._write_functions(
+                functions=functions, table_name=table_name, stats=stats
+            )
+        except Exception as e:
+            print("Error in FlaskAPIHandler._encode_from_path: ", e)
+            self._delete_project(url=url)
+            return False
+
+        self._update_commit_sha(
+            table_name=table_name, commit_sha=self._get_head_sha(project_path)
+        )
 
-    def _encode_from_path(self, project_path, table_name, is_public, request):
-        for root, dirs, files in os.walk(project_path):
-            for file in files:
-                if file.endswith(".py") or file.endswith(".js"):
-                    file_path = os.path.join(root, file)
-                    func_list = self._parse_file(file_path)
-
-                    if file.endswith(".py"):
-                        language = "python"
-                    elif file.endswith(".js"):
-                        language = "javascript"
-
-                    for func in func_list:
-                        function_name = func["func_name"]
-                        class_name = func["class_name"]
-                        line_number = func["line_number"]
-                        function_def = func["source"]
-
-                        encode_string = self._generate_encoding_string(
-                            language=language,
-                            function_def=function_def,
-                            function_name=function_name,
-                            class_name=class_name,
+        return True
+
+    # Files changed since old_sha (committed or not) according to git, None if git cannot tell
+    # (not a repository, no previous SHA or a shallow clone without that commit)
+    def _get_git_changed_files(self, project_path, old_sha):
+        if old_sha is None:
+            return None
+
+        try:
+            diff = subprocess.run(
+                ["git", "-C", project_path, "diff", "--name-only", "--relative"]
+                + [old_sha, "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            status = subprocess.run(
+                ["git", "-C", project_path, "ls-files", "--modified", "--others"]
+                + ["--exclude-standard"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        except Exception:
+            return None
+
+        return set(
+            os.path.join(project_path, name)
+            for name in diff.stdout.splitlines() + status.stdout.splitlines()
+        )
+
+    # Returns (paths of new or changed files, stored filepaths of removed files)
+    def _get_changed_files(
+        self, project_path, table_name, is_public, old_sha, stats=None
+    ):
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT filepath, MAX(file_hash), MAX(file_mtime) FROM embeddings_{}
+            GROUP BY filepath;
+            """.format(
+                table_name
+            )
+        )
+        stored_files = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+        git_changed_files = self._get_git_changed_files(project_path, old_sha)
+
+        changed_files = []
+        current_files = set()
+
+        for file_path in self._get_source_files(project_path, stats=stats):
+            filepath = self._get_stored_filepath(file_path, is_public)
+            current_files.add(filepath)
+
+            if filepath not in stored_files:
+                changed_files.append(file_path)
+            elif git_changed_files is not None:
+                if file_path in git_changed_files:
+                    changed_files.append(file_path)
+            else:
+                # Cheap mtime check first, the hash is only computed for touched files
+                file_hash, file_mtime = stored_files[filepath]
+                if file_mtime is not None and file_mtime == os.path.getmtime(file_path):
+                    continue
+                if file_hash != self._get_file_hash(file_path):
+                    changed_files.append(file_path)
+
+        removed_files = [f for f in stored_files if f not in current_files]
+
+        return changed_files, removed_files
+
+    # Applies removed rows and rows added after min_id to the persisted index, instead of rebuilding it.
+    # The index is patched on a private copy, searches keep using the cached one until it is replaced.
+    # Called before the removed rows are deleted, so a published index never returns a deleted row.
+    def _patch_index(self, table_name, removed_ids, min_id):
+        index = self.index_registry.load(table_name)
+
+        if index is None:
+            self._generate_index(table_name=table_name, removed_ids=removed_ids)
+            return
+
+        storage = self._get_embedding_storage(table_name=table_name)
+        ids, embedding_np = storage.load(
+            conn=self.conn, table_name=table_name, min_id=min_id
+        )
+
+        try:
+            if len(removed_ids) > 0:
+                index.remove_ids(np.array(removed_ids, dtype="int64"))
+            if len(ids) > 0:
+                index.add_with_ids(embedding_np, ids)
+        except Exception as e:
+            # e.g. HNSW does not support remove_ids
+            print("Error in FlaskAPIHandler._patch_index, rebuilding the index: ", e)
+            self._generate_index(table_name=table_name, removed_ids=removed_ids)
+            return
+
+        print("Index size: ", index.ntotal)
+        with self._get_index_lock(table_name).write():
+            self.index_registry.put(table_name, self._to_device(index))
+
+    # Re-parses only changed files and re-embeds only functions whose content hash changed.
+    # Returns True on success, on failure the project is left as it was before the re-index.
+    def _reindex_from_path(self, project_path, table_name, is_public, stats=None):
+        old_sha = self._get_commit_sha(table_name=table_name)
+        new_sha = self._get_head_sha(project_path)
+        changed_files, removed_files = self._get_changed_files(
+            project_path=project_path,
+            table_name=table_name,
+            is_public=is_public,
+            old_sha=old_sha,
+            stats=stats,
+        )
+        print(
+            "Re-index: {} changed files, {} removed files".format(
+                len(changed_files), len(removed_files)
+            )
+        )
+
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT id, filepath, content_hash FROM embeddings_{} WHERE filepath = ANY(%s);
+            """.format(
+                table_name
+            ),
+            (
+                [self._get_stored_filepath(f, is_public) for f in changed_files]
+                + removed_files,
+            ),
+        )
+
+        # Rows of changed files, the ones still present after parsing are kept (only their line number
+        # and file state are updated), the others are deleted
+        old_rows = {}
+        for id, filepath, content_hash in cur.fetchall():
+            old_rows.setdefault((filepath, content_hash), []).append(id)
+
+        kept_rows = []
+
+        def get_new_functions():
+            functions = self._generate_functions(
+                file_paths=changed_files, is_public=is_public, stats=stats
+            )
+
+            for row, encode_string in functions:
+                ids = old_rows.get((row["filepath"], row["content_hash"]))
+
+                if ids:
+                    kept_rows.append(
+                        (
+                            ids.pop(),
+                            row["line_number"],
+                            row["file_hash"],
+                            row["file_mtime"],
                         )
+                    )
+                else:
+                    yield row, encode_string
 
-                        # This is added to retry after we fall into a RateLimit exception
-                        while True:
-                            try:
-                                embedding = self._get_embedding_from_input(
-                                    input=encode_string
-                                )
-
-                                embedding = embedding.tolist()
-
-                                print("embedding: ", len(embedding))
-
-                                self._update_embedding_table(
-                                    embedding=embedding,
-                                    function_name=function_name,
-                                    class_name=class_name,
-                                    filepath=file_path[
-                                        20 if is_public else 4 :
-                                    ],  # This is to remove unnecessary path from the filepath
-                                    line_number=line_number,
-                                    table_name=table_name,
-                                )
-
-                            except Exception as e:
-                                # Adding a sleep to avoid rate limit.
-                                print("Error in FlaskAPIHandler.handle_encode: ", e)
-
-                                if type(e) == openai.error.RateLimitError:
-                                    time.sleep(60)
-                                    continue
-                                else:
-                                    self.handle_delete(self, request)
-                                    return
-
-                            break
+        cur.execute(
+            """SELECT COALESCE(MAX(id), 0) FROM embeddings_{};""".format(table_name)
+        )
+        max_id = cur.fetchall()[0][0]
+        is_patched = False
 
-    # Return Flag:
+        try:
+            writer = self._write_functions(
+                functions=get_new_functions(), table_name=table_name, stats=stats
+            )
+
+            removed_ids = [id for ids in old_rows.values() for id in ids]
+
+            # The index without the removed rows is published first: until the rows are deleted below,
+            # searches (in every server worker) only miss rows that are about to go
+            self._patch_index(
+                table_name=table_name, removed_ids=removed_ids, min_id=max_id
+            )
+            is_patched = True
+
+            cur.execute(
+                """DELETE FROM embeddings_{} WHERE id = ANY(%s);""".format(table_name),
+                (removed_ids,),
+            )
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                UPDATE embeddings_{0} SET line_number = data.line_number::INT,
+                    file_hash = data.file_hash, file_mtime = data.file_mtime
+                FROM (VALUES %s) AS data (id, line_number, file_hash, file_mtime)
+                WHERE embeddings_{0}.id = data.id;
+                """.format(
+                    table_name
+                ),
+                kept_rows,
+            )
+            cur.execute(
+                """UPDATE mapping SET commit_sha = %s WHERE id = %s""",
+                (new_sha, table_name),
+            )
+            self._bump_table_version(table_name=table_name)
+            self.conn.commit()
+        except Exception as e:
+            print("Error in FlaskAPIHandler._reindex_from_path: ", e)
+            self.conn.rollback()
+            cur.execute(
+                """DELETE FROM embeddings_{} WHERE id > %s;""".format(table_name),
+                (max_id,),
+            )
+            # Searches may have cached the rows written before the failure
+            self._bump_table_version(table_name=table_name)
+            self.conn.commit()
+
+            # The published index has the new rows and lacks the removed ones, it is rebuilt from the table
+            if is_patched:
+                self._generate_index(table_name=table_name)
+
+            return False
+
+        print(
+            "Re-index: {} functions kept, {} added, {} removed".format(
+                len(kept_rows), writer.rows_written, len(removed_ids)
+            )
+        )
+
+        return True
+
+    # Runs on the job pool. Return Flag (the job's flag):
     #   0: Already encoded and stored in DB
     #   1: Encoding completed
+    #   3: Repository larger than MAX_SIZE
+    #   4: Encoding failed, nothing was stored
+    @with_connection
+    def _run_encode(self, url, is_public, job):
+        # Checked again, the project may have been encoded while the job was queued
+        flag, table_name = self._check_if_indexed(url)
+
+        if flag:
+            print("Already encoded project")
+            return 0
+
+        if is_public == "Yes":
+            clone_flag, project_path = self._clone_repo(url=url)
+
+            if clone_flag != 0:
+                return 3 if clone_flag == 1 else 4
+        else:
+            project_path = os.path.join("/mnt", url[1:])
+
+        # The clone is removed even when encoding raises, so failed jobs do not leave checkouts behind
+        try:
+            table_name = self._update_mapping_table(
+                url=url, is_public=is_public == "Yes"
+            )
+            self._create_embedding_table(table_name=table_name)
+            encode_flag = self._encode_from_path(
+                project_path=project_path,
+                table_name=table_name,
+                is_public=is_public == "Yes",
+                url=url,
+                stats=job.stats,
+            )
+        finally:
+            if is_public == "Yes":
+                shutil.rmtree(project_path, ignore_errors=True)
+
+        if not encode_flag:
+            return 4
+
+        self._generate_index(table_name=table_name)
+
+        return 1
+
+    # Return Flag:
+    #   0: Already encoded and stored in DB
     #   2: Incorrect is_public flag value entered
+    #   5: Encoding job started (or already running), its id is returned with the flag
+    @with_connection
     def handle_encode(self, request):
         url = request.form["url"]  # This can be public URL or local file path
         is_public = self._check_if_public(
             url=url
         )  # This can be "Yes" or "No" or "Error" depending on whether public URL or not
 
-        if is_public == "Yes":
-            if self._check_if_valid_url(url=url):
-                flag, table_name = self._check_if_indexed(url)
+        if is_public == "Error":
+            print("""Error: Wrong value in FlaskAPIHandler.handle_encode""")
+            return 2, None
 
-                if flag:
-                    # TODO: Return with some proper flag which says that already indexed project
-                    print("Already encoded project")
-                    return 0
-                else:
-                    clone_flag, project_path = self._clone_repo(url=url)
+        # The mapping row is written at the start of the job, so a running job comes first
+        job_id = self.job_manager.get_active(kind="encode", url=url)
+        if job_id is not None:
+            return 5, job_id
 
-                    if not clone_flag:
-                        return 3
+        flag, table_name = self._check_if_indexed(url=url)
 
-                    table_name = self._update_mapping_table(url=url, is_public=True)
-                    self._create_embedding_table(table_name=table_name)
-                    self._encode_from_path(
-                        project_path=project_path,
-                        table_name=table_name,
-                        is_public=True,
-                        request=request,
-                    )
-                    self._generate_index(table_name=table_name)
-                    shutil.rmtree(project_path)
+        if flag:
+            # TODO: Return with some proper flag which says that already indexed project
+            print("Already encoded project")
+            return 0, None
+
+        job_id = self.job_manager.submit(
+            kind="encode",
+            url=url,
+            target=lambda job: self._run_encode(url=url, is_public=is_public, job=job),
+        )
 
-        elif is_public == "No":
-            flag, table_name = self._check_if_indexed(url=url)
-            if flag:
-                # TODO: Return with some proper flag which says that already indexed project
-                return 0
-            else:
-                project_path = os.path.join("/mnt", url[1:])
+        return 5, job_id
 
-                table_name = self._update_mapping_table(url=url, is_public=False)
-                self._create_embedding_table(table_name=table_name)
-                self._encode_from_path(
+    # Runs on the job pool. Return Flag (the job's flag):
+    #   0: Re-index completed
+    #   2: Repository larger than MAX_SIZE
+    #   3: Re-index failed, the previous index is kept
+    @with_connection
+    def _run_reindex(self, url, is_public, table_name, job):
+        # Adds the re-index columns to tables created before they existed
+        self._create_embedding_table(table_name=table_name)
+
+        if is_public == "Yes":
+            clone_flag, project_path = self._clone_repo(url=url)
+
+            if clone_flag != 0:
+                return 2 if clone_flag == 1 else 3
+
+            try:
+                reindex_flag = self._reindex_from_path(
                     project_path=project_path,
                     table_name=table_name,
-                    is_public=False,
-                    request=request,
+                    is_public=True,
+                    stats=job.stats,
                 )
-                self._generate_index(table_name=table_name)
-
+            finally:
+                shutil.rmtree(project_path, ignore_errors=True)
         else:
-            print("""Error: Wrong value in FlaskAPIHandler.handle_encode""")
-            return 2
+            project_path = os.path.join("/mnt", url[1:])
+            reindex_flag = self._reindex_from_path(
+                project_path=project_path,
+                table_name=table_name,
+                is_public=False,
+                stats=job.stats,
+            )
 
-        return 1
+        return 0 if reindex_flag else 3
+
+    # Return Flag:
+    #   1: Project is not indexed or the input is incorrect
+    #   4: Re-index job started (or already running), its id is returned with the flag
+    #   5: The project was embedded with another model than model.code_embedding (for a local model, also with
+    #      other local_embedding quantize / pooling / max_length settings), it must be encoded again
+    @with_connection
+    def handle_reindex(self, request):
+        url = request.form["url"]  # This can be public URL or local file path
+        is_public = self._check_if_public(
+            url=url
+        )  # This can be "Yes" or "No" or "Error" depending on whether public URL or not
+
+        if is_public == "Error":
+            return 1, None
+
+        flag, table_name = self._check_if_indexed(url=url)
 
+        if not flag:
+            return 1, None
+
+        # Changed functions would be embedded with another model than the rest of the project
+        model = self._get_embedding_model(table_name=table_name)
+        storage = self._get_embedding_storage(table_name=table_name)
+        if (
+            model is not None and model != self.code_embedding_provider.model
+        ) or storage.dimension != self.code_embedding_provider.dimension:
+            return 5, None
+
+        job_id = self.job_manager.submit(
+            kind="reindex",
+            url=url,
+            target=lambda job: self._run_reindex(
+                url=url, is_public=is_public, table_name=table_name, job=job
+            ),
+        )
+
+        return 4, job_id
+
+    # The job as a dict (see JobManager), None for unknown job ids
+    def handle_job_status(self, job_id):
+        return self.job_manager.get(job_id)
+
+    # vector, lexical or hybrid (see _get_batch_nearest_neighbors), None for an unknown mode
+    def _get_search_mode(self, mode):
+        mode = mode or self.configs["search"]["default_mode"]
+
+        return mode if mode in SEARCH_MODES else None
+
+    @with_connection
     def handle_search(self, request):
         url = request.form["url"]  # This can be public URL or local file path
         query = request.form["query"]
         print("query: ", query)
-        self._create_faiss_index()
+
+        # Optional ANN settings, the index defaults from config.yaml are used otherwise
+        nprobe = request.form.get("nprobe", type=int)
+        ef_search = request.form.get("ef_search", type=int)
+
+        # Optional filters on filepath (prefix), class_name, function_name and language
+        filters = get_filters(request.form)
+
+        mode = self._get_search_mode(request.form.get("mode"))
 
         is_public = self._check_if_public(
             url=url
         )  # This can be "Yes" or "No" or "Error" depending on whether public URL or not
 
-        if is_public == "Error":
+        if is_public == "Error" or mode is None:
             return {}
 
         if is_public == "Yes":
             if not self._check_if_valid_url(url=url):
                 return {}
 
-        encode_flag = self.handle_encode(request=request)
+        # Projects that are not indexed yet are encoded in the background, the search returns nothing
+        # until the encoding job has finished
+        encode_flag, _ = self.handle_encode(request=request)
 
-        if encode_flag == 0 or encode_flag == 1:
-            flag, table_name = self._check_if_indexed(url)
-            self._generate_index(table_name=table_name)
+        if encode_flag != 0:
+            return {}
 
-            query_embedding = self._get_embedding_from_input(input=query)
-            result_dict = self._get_nearest_neighbors(
-                query_embedding=query_embedding, table_name=table_name
-            )
+        flag, table_name = self._check_if_indexed(url)
+
+        # Lexical searches do not need the query embedding (no call to the embedding provider)
+        query_embedding = (
+            None if mode == "lexical" else self._get_embedding_from_input(input=query)
+        )
+        result_dict = self._get_nearest_neighbors(
+            query_embedding=query_embedding,
+            table_name=table_name,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            filters=filters,
+            query=query,
+            mode=mode,
+        )
 
-            return result_dict
+        return result_dict
 
+    # Many queries against one or more projects. The input is a JSON body
+    #   {"queries": [...], "urls": [...], "nprobe": ..., "ef_search": ..., "filters": {...}, "mode": ...}
+    # or form data with repeated "query" and "url" fields (and the filters and mode as fields, as with handle_search). Projects that are not indexed get empty results
+    # (they are not encoded, unlike with handle_search), as do URLs that are neither a public repository nor a local
+    # project, the other URLs of the batch are still searched.
+    # Return Flag:
+    #   0: Search completed, the results are returned with the flag
+    #   1: Incorrect input
+    #   2: More than search.max_batch_queries queries
+    @with_connection
+    def handle_batch_search(self, request):
+        body = request.get_json(silent=True)
+
+        if body is not None:
+            queries = body.get("queries", [])
+            urls = body.get("urls", [])
+            nprobe = body.get("nprobe")
+            ef_search = body.get("ef_search")
+            filters = get_filters(body.get("filters", {}))
+            mode = self._get_search_mode(body.get("mode"))
         else:
-            return {}
+            queries = request.form.getlist("query")
+            urls = request.form.getlist("url")
+            nprobe = request.form.get("nprobe", type=int)
+            ef_search = request.form.get("ef_search", type=int)
+            filters = get_filters(request.form)
+            mode = self._get_search_mode(request.form.get("mode"))
+
+        if len(queries) == 0 or len(urls) == 0 or mode is None:
+            return 1, []
+
+        if len(queries) > self.configs["search"]["max_batch_queries"]:
+            return 2, []
+
+        query_embeddings = (
+            None
+            if mode == "lexical"
+            else self._get_embeddings_from_inputs(inputs=queries)
+        )
+        results = [{"query": query, "results": {}} for query in queries]
+
+        for url in urls:
+            if self._check_if_public(url=url) == "Error":
+                flag = False
+            else:
+                flag, table_name = self._check_if_indexed(url=url)
 
+            if flag:
+                result_dicts = self._get_batch_nearest_neighbors(
+                    query_embeddings=query_embeddings,
+                    table_name=table_name,
+                    nprobe=nprobe,
+                    ef_search=ef_search,
+                    filters=filters,
+                    queries=queries,
+                    mode=mode,
+                )
+            else:
+                result_dicts = [{} for _ in queries]
+
+            for result, result_dict in zip(results, result_dicts):
+                result["results"][url] = result_dict
+
+        return 0, results
+
+    # Top-k of one shard as (is_reranked, [(score, id)]), with k * rerank_factor unranked candidates for a
+    # compressed index, or None if the project has no persisted index. Runs on the shard pool, within
+    # search.shard_timeout: the index is loaded here (see IndexRegistry.get with cache=False), without a
+    # database connection (the metadata of a filtered search is loaded by the request thread).
+    # Shards starting after the global search timed out (cancelled) are skipped.
+    def _search_shard(
+        self,
+        query_embedding,
+        table_name,
+        k,
+        nprobe,
+        ef_search,
+        filters,
+        metadata,
+        cancelled,
+    ):
+        if cancelled.is_set():
+            return None
+
+        index = self.index_registry.get(table_name, cache=False)
+
+        if index is None:
+            return None
+
+        if index.d != len(query_embedding):
+            raise ValueError(
+                "Project embedded with another model (dimension {})".format(index.d)
+            )
+
+        D, I = self._search_index(
+            index=index,
+            table_name=table_name,
+            query_embeddings=np.expand_dims(query_embedding, axis=0),
+            k=k,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            filters=filters,
+            metadata=metadata,
+            rerank=False,
+        )
+
+        return self._is_reranked(index), [
+            (float(d), int(id)) for d, id in zip(D[0], I[0]) if id >= 0
+        ]
+
+    # Builds the index of a project that has none persisted (e.g. indexed before indexes were persisted, or
+    # dropped on startup) on the index build pool, once per project and server worker
+    def _schedule_index_build(self, table_name, url):
+        with self.index_builds_lock:
+            if table_name in self.index_builds:
+                return
+            self.index_builds.add(table_name)
+
+        self.index_build_executor.submit(self._run_index_build, table_name, url)
+
+    @with_connection
+    def _run_index_build(self, table_name, url):
+        try:
+            # A project being encoded gets its index at the end of the encoding job
+            if self.job_manager.get_active(kind="encode", url=url) is None:
+                self._get_index(table_name=table_name)
+        except Exception as e:
+            print("Error in FlaskAPIHandler._run_index_build: ", e)
+        finally:
+            with self.index_builds_lock:
+                self.index_builds.discard(table_name)
+
+    # Search over every indexed project: the shards are searched in parallel and their top-k lists are
+    # merged into a global top-k by score (inner product of normalized embeddings, comparable across
+    # projects). Shards that are not done within search.shard_timeout seconds (loading their index
+    # included) are left out, so the latency does not grow with the slowest shard or the number of
+    # projects. Skipped projects are listed in the response, projects without an index are indexed in
+    # the background.
+    # Only the request thread uses the database (one pooled connection per global search): it loads the
+    # metadata of filtered searches before the shards run, and re-ranks the global top k * rerank_factor
+    # candidates of compressed shards after them.
+    @with_connection
+    def handle_global_search(self, request):
+        query = request.form["query"]
+        k = request.form.get(
+            "k", default=self.configs["model"]["num_nearest_neighbours"], type=int
+        )
+        nprobe = request.form.get("nprobe", type=int)
+        ef_search = request.form.get("ef_search", type=int)
+        filters = get_filters(request.form)
+
+        cur = self.conn.cursor()
+        cur.execute("""SELECT id, url, version FROM mapping""")
+        rows = cur.fetchall()
+        projects = {row[0]: row[1] for row in rows}
+        versions = {row[0]: row[2] for row in rows}
+
+        query_embedding = self._get_embedding_from_input(input=query)
+        start_time = time.monotonic()
+
+        not_indexed = []
+        failed = []
+        # table name -> metadata of the filtered search (None without filters)
+        shards = {}
+
+        for table_name in projects:
+            try:
+                shards[table_name] = (
+                    self._get_index_data(
+                        cls=ProjectMetadata,
+                        table_name=table_name,
+                        version=versions[table_name],
+                    )
+                    if filters
+                    else None
+                )
+            except Exception as e:
+                print("Error in FlaskAPIHandler.handle_global_search: ", e)
+                self.conn.rollback()
+                failed.append(projects[table_name])
+
+        cancelled = threading.Event()
+        futures = {
+            self.shard_executor.submit(
+                self._search_shard,
+                query_embedding,
+                table_name,
+                k,
+                nprobe,
+                ef_search,
+                filters,
+                metadata,
+                cancelled,
+            ): table_name
+            for table_name, metadata in shards.items()
+        }
+        done, not_done = wait(futures, timeout=self.configs["search"]["shard_timeout"])
+
+        # Running shards finish their FAISS search, queued ones are cancelled or skip it
+        cancelled.set()
+        for future in not_done:
+            future.cancel()
+
+        candidates = []
+        reranked_candidates = []
+
+        for future in done:
+            table_name = futures[future]
+
+            try:
+                result = future.result()
+            except Exception as e:
+                print("Error in FlaskAPIHandler.handle_global_search: ", e)
+                failed.append(projects[table_name])
+                continue
+
+            if result is None:
+                not_indexed.append(projects[table_name])
+                self._schedule_index_build(
+                    table_name=table_name, url=projects[table_name]
+                )
+                continue
+
+            is_reranked, results = result
+            if is_reranked:
+                reranked_candidates.extend((d, table_name, id) for d, id in results)
+            else:
+                candidates.extend((d, table_name, id) for d, id in results)
+
+        # Exact scores for the best candidates of compressed shards, one query per project among them
+        reranked_candidates = heapq.nlargest(
+            k * self.configs["index"]["compression"]["rerank_factor"],
+            reranked_candidates,
+            key=lambda candidate: candidate[0],
+        )
+        for table_name in set(table_name for _, table_name, _ in reranked_candidates):
+            ids = [id for _, t, id in reranked_candidates if t == table_name]
+            D, I = self._rerank(
+                table_name=table_name,
+                query_embeddings=np.expand_dims(query_embedding, axis=0),
+                candidate_ids=np.array([ids], dtype="int64"),
+                k=len(ids),
+            )
+            candidates.extend(
+                (float(d), table_name, int(id)) for d, id in zip(D[0], I[0]) if id >= 0
+            )
+
+        top_k = heapq.nlargest(k, candidates, key=lambda candidate: candidate[0])
+
+        # Metadata only for the global top-k, one query per project in it
+        metadata = {}
+        for table_name in set(table_name for _, table_name, _ in top_k):
+            metadata[table_name] = self._get_function_metadata(
+                ids=[id for _, t, id in top_k if t == table_name], table_name=table_name
+            )
+
+        result_dict = {}
+
+        # Rows deleted by a re-index after the shard's index was loaded are left out
+        top_k = [
+            (score, table_name, id)
+            for score, table_name, id in top_k
+            if id in metadata[table_name]
+        ]
+
+        for i, (score, table_name, id) in enumerate(top_k):
+            result = metadata[table_name][id]
+            result_dict["{}".format(i)] = {
+                "url": projects[table_name],
+                "function_name": result[0],
+                "class_name": result[1],
+                "filepath": result[2],
+                "line_number": result[3],
+                "score": score,
+            }
+
+        return {
+            "results": result_dict,
+            "num_projects": len(projects),
+            "timed_out": sorted(projects[futures[future]] for future in not_done),
+            "not_indexed": sorted(not_indexed),
+            "failed": sorted(failed),
+            "search_time_ms": (time.monotonic() - start_time) * 1000,
+        }
+
+    # Drops the project's mapping row, embeddings table, index and embeddings sidecar.
+    # Returns 0 on success and 1 otherwise.
+    def _delete_project(self, url):
+        flag, table_name = self._check_if_indexed(url=url)
+
+        if flag:
+            storage = self._get_embedding_storage(table_name=table_name)
+            cur = self.conn.cursor()
+
+            try:
+                cur.execute("""DELETE FROM mapping WHERE id='{}'""".format(table_name))
+                cur.execute("""DROP TABLE embeddings_{}""".format(table_name))
+                self.conn.commit()
+                with self._get_index_lock(table_name).write():
+                    self.index_registry.invalidate(table_name)
+                self._drop_index_data(table_name)
+                storage.delete(table_name=table_name)
+
+                return 0
+            except Exception as e:
+                print("Error in FlaskAPIHandler._delete_project: ", e)
+                self.conn.rollback()
+                return 1
+
+        return 1
+
+    @with_connection
     def handle_delete(self, request):
         url = request.form["url"]
         print("URL: ", url)
@@ -471,21 +1888,75 @@ class FlaskAPIHandler(object):
             if not self._check_if_valid_url(url=url):
                 return 1
 
+        return self._delete_project(url=url)
+
+    # Recall@k and latency of every index type on the project's own vectors, to pick index settings
+    @with_connection
+    def handle_index_report(self, request):
+        url = request.values["url"]
         flag, table_name = self._check_if_indexed(url=url)
 
-        if flag:
-            cur = self.conn.cursor()
+        if not flag:
+            return []
 
-            try:
-                cur.execute("""DELETE FROM mapping WHERE id='{}'""".format(table_name))
-                cur.execute("""DROP TABLE embeddings_{}""".format(table_name))
-                self.conn.commit()
+        storage = self._get_embedding_storage(table_name=table_name)
+        _, embedding_np = storage.load(conn=self.conn, table_name=table_name)
+        report_configs = self.configs["index"]["report"]
 
-                return 0
-            except Exception as e:
-                print("Error in FlaskAPIHandler.handle_delete: ", e)
-                return 1
+        if len(embedding_np) <= report_configs["num_queries"]:
+            return []
+
+        return get_recall_report(
+            embeddings=embedding_np,
+            index_configs=self.configs["index"],
+            num_queries=report_configs["num_queries"],
+            k=self.configs["model"]["num_nearest_neighbours"],
+            nprobe=report_configs["nprobe"],
+            ef_search=report_configs["ef_search"],
+        )
+
+    # Memory of the project's index and memory / recall@k of every compression setting on the project's vectors
+    @with_connection
+    def handle_index_memory_report(self, request):
+        url = request.values["url"]
+        flag, table_name = self._check_if_indexed(url=url)
+
+        if not flag:
+            return {}
 
+        index = self._get_index(table_name=table_name)
+        storage = self._get_embedding_storage(table_name=table_name)
+        _, embedding_np = storage.load(conn=self.conn, table_name=table_name)
+        report_configs = self.configs["index"]["report"]
+
+        if len(embedding_np) <= report_configs["num_queries"]:
+            return {"index": get_index_summary(index), "settings": []}
+
+        return {
+            "index": get_index_summary(index),
+            "settings": get_compression_report(
+                embeddings=embedding_np,
+                index_configs=self.configs["index"],
+                num_queries=report_configs["num_queries"],
+                k=self.configs["model"]["num_nearest_neighbours"],
+                codecs=report_configs["codecs"],
+                reductions=report_configs["reductions"],
+            ),
+        }
+
+    # Hit rates of the caches of this server worker
+    def handle_metrics(self):
+        return {
+            "pid": os.getpid(),
+            "query_cache": self.query_cache.get_stats()
+            if self.query_cache is not None
+            else None,
+            "embedding_cache": self.embedding_cache.get_stats()
+            if self.embedding_cache is not None
+            else None,
+        }
+
+    @with_connection
     def handle_root(self):
         try:
             cur = self.conn.cursor()
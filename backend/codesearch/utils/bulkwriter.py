@@ -0,0 +1,81 @@
+import io
+import time
+
+## Notes:
+# 1.) Buffers rows in memory and writes them with a single COPY per batch, each batch is one transaction
+# 2.) A failed batch is rolled back and the error is re-raised, the caller is responsible for dropping
+#     the rows of earlier batches (see FlaskAPIHandler._encode_from_path)
+# 3.) Values are written in the COPY text format, so None becomes \N and special characters are escaped
+
+_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _format_value(value):
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bytes):
+        # bytea hex format, the backslash is escaped below like any other
+        value = "\\x" + value.hex()
+    elif isinstance(value, (list, tuple)):
+        # Postgres array literal, e.g. {0.1,0.2}
+        return "{" + ",".join(repr(float(item)) for item in value) + "}"
+
+    return str(value).translate(_ESCAPES)
+
+
+class BulkWriter(object):
+    def __init__(self, conn, table, columns, batch_size, before_commit=None):
+        self.conn = conn
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        # Called before every commit, e.g. to make sidecar files durable before rows reference them
+        self.before_commit = before_commit
+
+        self.buffer = []
+        self.rows_written = 0
+        self.write_time = 0
+
+    def add(self, row):
+        self.buffer.append(row)
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        start_time = time.monotonic()
+
+        data = io.StringIO()
+        for row in self.buffer:
+            data.write("\t".join(_format_value(value) for value in row))
+            data.write("\n")
+        data.seek(0)
+
+        if self.before_commit is not None:
+            self.before_commit()
+
+        cur = self.conn.cursor()
+        try:
+            cur.copy_expert(
+                "COPY {} ({}) FROM STDIN".format(self.table, ", ".join(self.columns)),
+                data,
+            )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self.rows_written += len(self.buffer)
+        self.write_time += time.monotonic() - start_time
+        self.buffer = []
+
+    def get_rows_per_sec(self):
+        return self.rows_written / max(self.write_time, 1e-9)
+
+    def __str__(self):
+        return "rows written: {}, write time: {:.1f}s, {:.1f} rows/sec".format(
+            self.rows_written, self.write_time, self.get_rows_per_sec()
+        )
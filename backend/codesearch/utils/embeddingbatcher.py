@@ -0,0 +1,55 @@
+## Notes:
+# 1.) Groups encoding strings into requests bounded by an item count and an (estimated) token budget
+# 2.) Tokens are estimated from the string length, the ratio is configurable as code tokenizes worse than prose
+# 3.) Inputs longer than the per-input token limit are truncated instead of failing the whole request
+
+
+class EmbeddingBatcher(object):
+    def __init__(
+        self, provider, max_items, max_tokens, max_input_tokens, chars_per_token=3
+    ):
+        self.provider = provider
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.max_input_tokens = max_input_tokens
+        self.chars_per_token = chars_per_token
+
+    def estimate_tokens(self, input):
+        return len(input) // self.chars_per_token + 1
+
+    def truncate(self, input):
+        return input[: self.max_input_tokens * self.chars_per_token]
+
+    # items is an iterable of (key, encoding string), yields lists of (key, truncated encoding string)
+    def batches(self, items):
+        batch = []
+        batch_tokens = 0
+
+        for key, input in items:
+            input = self.truncate(input)
+            tokens = self.estimate_tokens(input)
+
+            if batch and (
+                len(batch) >= self.max_items or batch_tokens + tokens > self.max_tokens
+            ):
+                yield batch
+                batch = []
+                batch_tokens = 0
+
+            batch.append((key, input))
+            batch_tokens += tokens
+
+        if batch:
+            yield batch
+
+    # Returns a list of (key, embedding) in the order of the batch
+    def embed_batch(self, batch):
+        embeddings = self.provider.embed([input for _, input in batch])
+
+        assert len(embeddings) == len(
+            batch
+        ), "The embedding provider returned {} embeddings for {} inputs".format(
+            len(embeddings), len(batch)
+        )
+
+        return [(key, embedding) for (key, _), embedding in zip(batch, embeddings)]
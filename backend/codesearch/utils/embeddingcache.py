@@ -0,0 +1,199 @@
+import hashlib
+import threading
+
+import numpy as np
+import psycopg2.extras
+
+## Notes:
+# 1.) Content-addressed cache of embeddings shared by all projects, keyed by (model, sha1 of the input)
+# 2.) Stored in the embedding_cache table as packed float32, so identical functions in forks, vendored
+#     code and re-indexed repos are only sent to the embedding provider once
+# 3.) Size based eviction: when the cache holds more than max_bytes of vectors, the least recently used
+#     entries are deleted. The size is counted from the table (every server worker writes to it) at startup,
+#     and again whenever this process has added RECOUNT_FRACTION * max_bytes since or its estimate is above
+#     max_bytes, so the cache exceeds max_bytes by at most RECOUNT_FRACTION * max_bytes per server worker.
+#     Entries are only deleted if the counted size is above max_bytes.
+# 4.) Lookups are reads: last_used is only bumped for entries last used more than touch_interval seconds ago,
+#     so re-encoding a project does not rewrite every cached row
+# 5.) The cache has its own connection, access is serialized with a lock as embedding workers share it
+
+RECOUNT_FRACTION = 0.01
+
+
+def get_input_hash(input):
+    return hashlib.sha1(input.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache(object):
+    def __init__(self, conn, max_bytes, evict_fraction=0.1, touch_interval=3600):
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self.evict_fraction = evict_fraction
+        self.touch_interval = touch_interval
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                model TEXT,
+                content_hash TEXT,
+                embedding BYTEA,
+                last_used TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (model, content_hash)
+            );
+            CREATE INDEX IF NOT EXISTS embedding_cache_last_used ON embedding_cache (last_used);
+            """
+        )
+        self.conn.commit()
+
+        self._count()
+
+    # Size of the cache from the table, including the entries written by other server workers
+    def _count(self):
+        cur = self.conn.cursor()
+        cur.execute(
+            """SELECT COUNT(*), COALESCE(SUM(OCTET_LENGTH(embedding)), 0) FROM embedding_cache"""
+        )
+        self.num_entries, self.num_bytes = cur.fetchall()[0]
+        self.conn.commit()
+
+        self.unchecked_bytes = 0  # Bytes added by this process since the last count
+
+    # Returns {hash: embedding} for the hashes found in the cache
+    def get_many(self, model, hashes):
+        with self.lock:
+            cur = self.conn.cursor()
+            try:
+                cur.execute(
+                    """
+                    SELECT content_hash, embedding,
+                        last_used < NOW() - %s * INTERVAL '1 second' FROM embedding_cache
+                    WHERE model = %s AND content_hash = ANY(%s);
+                    """,
+                    (self.touch_interval, model, list(hashes)),
+                )
+                rows = cur.fetchall()
+
+                stale = [content_hash for content_hash, _, is_stale in rows if is_stale]
+                if stale:
+                    cur.execute(
+                        """
+                        UPDATE embedding_cache SET last_used = NOW()
+                        WHERE model = %s AND content_hash = ANY(%s)
+                            AND last_used < NOW() - %s * INTERVAL '1 second';
+                        """,
+                        (model, stale, self.touch_interval),
+                    )
+                self.conn.commit()
+            except Exception as e:
+                print("Error in EmbeddingCache.get_many: ", e)
+                self.conn.rollback()
+                rows = []
+
+            found = {
+                content_hash: np.frombuffer(embedding, dtype="float32")
+                for content_hash, embedding, _ in rows
+            }
+            self.hits += len(found)
+            self.misses += len(set(hashes)) - len(found)
+
+            return found
+
+    # embeddings is a dict {hash: embedding}
+    def put_many(self, model, embeddings):
+        if not embeddings:
+            return
+
+        with self.lock:
+            cur = self.conn.cursor()
+            try:
+                rows = psycopg2.extras.execute_values(
+                    cur,
+                    """
+                    INSERT INTO embedding_cache (model, content_hash, embedding) VALUES %s
+                    ON CONFLICT DO NOTHING RETURNING OCTET_LENGTH(embedding);
+                    """,
+                    [
+                        (
+                            model,
+                            content_hash,
+                            psycopg2.Binary(
+                                np.asarray(embedding, dtype="float32").tobytes()
+                            ),
+                        )
+                        for content_hash, embedding in embeddings.items()
+                    ],
+                    fetch=True,
+                )
+                self.conn.commit()
+            except Exception as e:
+                print("Error in EmbeddingCache.put_many: ", e)
+                self.conn.rollback()
+                return
+
+            self.num_entries += len(rows)
+            self.num_bytes += sum(row[0] for row in rows)
+            self.unchecked_bytes += sum(row[0] for row in rows)
+
+            if (
+                self.num_bytes > self.max_bytes
+                or self.unchecked_bytes > RECOUNT_FRACTION * self.max_bytes
+            ):
+                self._evict()
+
+    def _evict(self):
+        cur = self.conn.cursor()
+        try:
+            self._count()
+            if self.num_bytes <= self.max_bytes:
+                return
+
+            # Evicts a fraction of the entries at once, so eviction does not run on every put
+            num_evict = max(1, int(self.num_entries * self.evict_fraction))
+            cur.execute(
+                """
+                DELETE FROM embedding_cache WHERE ctid IN (
+                    SELECT ctid FROM embedding_cache ORDER BY last_used LIMIT %s
+                ) RETURNING OCTET_LENGTH(embedding);
+                """,
+                (num_evict,),
+            )
+            rows = cur.fetchall()
+            self.conn.commit()
+        except Exception as e:
+            print("Error in EmbeddingCache._evict: ", e)
+            self.conn.rollback()
+            return
+
+        self.num_entries -= len(rows)
+        self.num_bytes -= sum(row[0] for row in rows)
+        self.evictions += len(rows)
+
+    def get_hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.get_hit_rate(),
+            "evictions": self.evictions,
+            "entries": self.num_entries,
+            "bytes": self.num_bytes,
+        }
+
+    def __str__(self):
+        return (
+            "hits: {}, misses: {}, hit rate: {:.2f}, evictions: {}, entries: {}".format(
+                self.hits,
+                self.misses,
+                self.get_hit_rate(),
+                self.evictions,
+                self.num_entries,
+            )
+        )
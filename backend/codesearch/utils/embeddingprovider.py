@@ -0,0 +1,110 @@
+import hashlib
+import threading
+
+import numpy as np
+import openai
+
+## Notes:
+# 1.) An embedding provider turns a list of strings into a float32 matrix of shape (len(inputs), dimension)
+# 2.) Row i of the output is always the embedding of inputs[i]
+# 3.) FakeEmbeddingProvider is deterministic and makes no network calls, it is meant for local testing
+# 4.) Providers raise RateLimitError (with the retry-after hint in seconds, if any) when the quota is exceeded
+# 5.) provider.dimension is the size of its embeddings and provider.model identifies them (the embedding and query
+#     caches are keyed by it), both are recorded per project when the project is encoded
+# 6.) Models named local:<model directory> run on CPU without network calls (see LocalEmbeddingProvider).
+#     They are loaded once per process and shared, e.g. by the code and the text embedding providers
+
+LOCAL_MODEL_PREFIX = "local:"
+
+_local_providers = {}
+_local_providers_lock = threading.Lock()
+
+
+class RateLimitError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class EmbeddingProvider(object):
+    def __init__(self, model, dimension=None):
+        self.model = model
+        self.dimension = dimension
+
+    def embed(self, inputs):
+        raise NotImplementedError
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    def _get_retry_after(self, error):
+        try:
+            return float(error.headers["retry-after"])
+        except Exception:
+            return None
+
+    def embed(self, inputs):
+        try:
+            response = openai.Embedding.create(input=inputs, model=self.model)
+        except openai.error.RateLimitError as e:
+            raise RateLimitError(str(e), retry_after=self._get_retry_after(e))
+
+        # The API returns one item per input, tagged with the position of that input
+        data = sorted(response["data"], key=lambda item: item["index"])
+
+        return np.array([item["embedding"] for item in data], dtype="float32")
+
+
+class FakeEmbeddingProvider(EmbeddingProvider):
+    def __init__(self, model, dimension):
+        super().__init__(model, dimension=dimension)
+        self.calls = []  # Batch size of every embed() call
+
+    def _get_vector(self, input):
+        seed = int(hashlib.sha256(input.encode("utf-8")).hexdigest()[:16], 16)
+        vector = np.random.default_rng(seed).standard_normal(self.dimension)
+
+        return vector / np.linalg.norm(vector)
+
+    def embed(self, inputs):
+        self.calls.append(len(inputs))
+
+        return np.array([self._get_vector(input) for input in inputs], dtype="float32")
+
+
+def _get_local_provider(configs, model):
+    # Imported here, onnxruntime and tokenizers are only needed for local models
+    from .localembedding import LocalEmbeddingProvider
+
+    local_configs = configs["local_embedding"]
+
+    with _local_providers_lock:
+        if model not in _local_providers:
+            _local_providers[model] = LocalEmbeddingProvider(
+                model=model,
+                model_dir=model[len(LOCAL_MODEL_PREFIX) :],
+                num_threads=local_configs["num_threads"],
+                quantize=local_configs["quantize"],
+                pooling=local_configs["pooling"],
+                max_length=local_configs["max_length"],
+                max_batch_tokens=local_configs["max_batch_tokens"],
+                max_wait_ms=local_configs["max_wait_ms"],
+            )
+
+        return _local_providers[model]
+
+
+def get_embedding_provider(configs, model):
+    provider = configs["model"].get("embedding_provider", "openai")
+
+    if model.startswith(LOCAL_MODEL_PREFIX):
+        return _get_local_provider(configs=configs, model=model)
+    elif provider == "openai":
+        return OpenAIEmbeddingProvider(
+            model=model, dimension=configs["model"]["dimension"]
+        )
+    elif provider == "fake":
+        return FakeEmbeddingProvider(
+            model=model, dimension=configs["model"]["dimension"]
+        )
+    else:
+        raise Exception("Unknown embedding provider: {}".format(provider))
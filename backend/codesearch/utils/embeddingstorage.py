@@ -0,0 +1,195 @@
+import os
+import struct
+
+import numpy as np
+
+## Notes:
+# 1.) Storage modes for the vectors of an embeddings_<id> table:
+#   - array: FLOAT[dimension] column (double precision, legacy format)
+#   - bytea_float32 / bytea_float16: packed little endian vector in a BYTEA column
+#   - npy_float32 / npy_float16: vectors in a sidecar .npy file, the table only keeps the row offset in that file
+# 2.) The mode is recorded per project in the mapping table, so changing the config only affects new projects
+# 3.) The sidecar header is padded to a fixed size so that the shape can be rewritten in place while appending,
+#     the file stays a regular .npy that np.load(..., mmap_mode="r") can open
+
+STORAGE_MODES = (
+    "array",
+    "bytea_float32",
+    "bytea_float16",
+    "npy_float32",
+    "npy_float16",
+)
+
+_NPY_HEADER_SIZE = 128
+
+
+class NpyAppender(object):
+    def __init__(self, path, dimension, dtype):
+        self.path = path
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+
+        if os.path.isfile(path):
+            self.num_rows = np.load(path, mmap_mode="r").shape[0]
+            self.file = open(path, "r+b")
+        else:
+            self.num_rows = 0
+            self.file = open(path, "w+b")
+            self._write_header()
+
+        self.file.seek(
+            _NPY_HEADER_SIZE + self.num_rows * self.dimension * self.dtype.itemsize
+        )
+
+    def _write_header(self):
+        header = (
+            "{{'descr': '{}', 'fortran_order': False, 'shape': ({}, {}), }}".format(
+                self.dtype.str, self.num_rows, self.dimension
+            )
+        )
+        header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + "\n"
+
+        self.file.seek(0)
+        self.file.write(b"\x93NUMPY\x01\x00")
+        self.file.write(struct.pack("<H", len(header)))
+        self.file.write(header.encode("latin1"))
+
+    # Returns the offset of the appended row
+    def append(self, embedding):
+        self.file.write(np.asarray(embedding, dtype=self.dtype).tobytes())
+        self.num_rows += 1
+
+        return self.num_rows - 1
+
+    def flush(self):
+        position = self.file.tell()
+        self._write_header()
+        self.file.seek(position)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class EmbeddingStorage(object):
+    def __init__(self, storage, dimension, data_dir):
+        assert storage in STORAGE_MODES, "Unknown embedding storage: {}".format(storage)
+
+        self.storage = storage
+        self.dimension = dimension
+        self.data_dir = data_dir
+        self.dtype = np.dtype(storage.split("_")[-1]) if storage != "array" else None
+
+    def get_column_name(self):
+        if self.storage.startswith("npy"):
+            return "vector_offset"
+
+        return "embedding"
+
+    def get_column_type(self):
+        if self.storage == "array":
+            return "FLOAT[{}]".format(self.dimension)
+        elif self.storage.startswith("bytea"):
+            return "BYTEA"
+
+        return "BIGINT"
+
+    def get_sidecar_path(self, table_name):
+        return os.path.join(self.data_dir, "embeddings_{}.npy".format(table_name))
+
+    def open_appender(self, table_name):
+        if not self.storage.startswith("npy"):
+            return None
+
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        return NpyAppender(
+            path=self.get_sidecar_path(table_name),
+            dimension=self.dimension,
+            dtype=self.dtype,
+        )
+
+    # Value stored in the embeddings table for this embedding
+    def encode(self, embedding, appender=None):
+        if self.storage == "array":
+            return embedding.tolist()
+        elif self.storage.startswith("bytea"):
+            return np.asarray(embedding, dtype=self.dtype).tobytes()
+
+        return appender.append(embedding)
+
+    # Returns (ids, embeddings) ordered by id, embeddings is a float32 matrix of shape (n, dimension).
+    # With min_id only the rows with a larger id are loaded (rows added since min_id was read).
+    def load(self, conn, table_name, min_id=0):
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, {} FROM embeddings_{} WHERE id > %s ORDER BY id;".format(
+                self.get_column_name(), table_name
+            ),
+            (min_id,),
+        )
+        rows = cur.fetchall()
+
+        ids = np.fromiter((row[0] for row in rows), dtype="int64", count=len(rows))
+
+        if len(rows) == 0:
+            return ids, np.zeros((0, self.dimension), dtype="float32")
+
+        if self.storage == "array":
+            embeddings = np.array([row[1] for row in rows], dtype="float32")
+        elif self.storage.startswith("bytea"):
+            embeddings = np.frombuffer(
+                b"".join(row[1] for row in rows), dtype=self.dtype
+            ).reshape(-1, self.dimension)
+        else:
+            sidecar = np.load(self.get_sidecar_path(table_name), mmap_mode="r")
+            offsets = np.fromiter(
+                (row[1] for row in rows), dtype="int64", count=len(rows)
+            )
+
+            if np.array_equal(offsets, np.arange(len(offsets))):
+                # Zero-copy view of the memory mapped file
+                embeddings = sidecar[: len(offsets)]
+            else:
+                embeddings = sidecar[offsets]
+
+        return ids, embeddings.astype("float32", copy=False)
+
+    # Returns (ids, embeddings) of the given ids ordered by id (ids that no longer exist are left out),
+    # used to re-rank the candidates of a compressed index
+    def load_ids(self, conn, table_name, ids):
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, {} FROM embeddings_{} WHERE id = ANY(%s) ORDER BY id;".format(
+                self.get_column_name(), table_name
+            ),
+            ([int(id) for id in ids],),
+        )
+        rows = cur.fetchall()
+
+        found_ids = np.fromiter(
+            (row[0] for row in rows), dtype="int64", count=len(rows)
+        )
+
+        if len(rows) == 0:
+            return found_ids, np.zeros((0, self.dimension), dtype="float32")
+
+        if self.storage == "array":
+            embeddings = np.array([row[1] for row in rows], dtype="float32")
+        elif self.storage.startswith("bytea"):
+            embeddings = np.frombuffer(
+                b"".join(row[1] for row in rows), dtype=self.dtype
+            ).reshape(-1, self.dimension)
+        else:
+            sidecar = np.load(self.get_sidecar_path(table_name), mmap_mode="r")
+            embeddings = sidecar[[row[1] for row in rows]]
+
+        return found_ids, embeddings.astype("float32", copy=False)
+
+    def delete(self, table_name):
+        path = self.get_sidecar_path(table_name)
+
+        if os.path.isfile(path):
+            os.remove(path)
@@ -0,0 +1,249 @@
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .simpleast import SimpleAST
+from .simplecst import SimpleCST
+from .simpletreesitter import SimpleTreeSitter
+
+## Notes:
+# 1.) parse_file() returns the func_list of a single file (see SimpleCST / SimpleTreeSitter for the format),
+#     iter_file_functions() yields the same records one at a time
+# 2.) ParallelParser fans files out to a process pool and yields results as they complete, with at most
+#     max_pending files in flight so that results are streamed instead of collected
+# 3.) Files larger than max_file_bytes are skipped, and a file taking longer than timeout seconds to parse
+#     is abandoned (SIGALRM in the worker; a long running native call is only interrupted once it returns)
+# 4.) Workers are started from a forkserver, forking the multi-threaded Flask process directly is unsafe.
+#     The forkserver preloads only this module instead of __main__ (the default), which would run the server's
+#     entry point in it
+# 5.) With num_workers = 0 files are parsed in the calling thread and the records are streamed straight
+#     from the tree walk, so at most one file's functions are in flight (no timeout is enforced)
+# 6.) Python files are parsed with parsing.python_backend: ast (stdlib, default), treesitter or libcst.
+#     ast / treesitter fall back to LibCST for files they fail on. benchmark() compares the backends.
+
+PYTHON_BACKENDS = ("ast", "treesitter", "libcst")
+
+
+def get_language(filepath):
+    if filepath.endswith(".py"):
+        return "python"
+    elif filepath.endswith(".js"):
+        return "javascript"
+
+    return None
+
+
+def _get_python_parser(filepath, python_backend):
+    if python_backend == "ast":
+        simple_ast = SimpleAST()
+        simple_ast.set_module(filepath=filepath)
+
+        return simple_ast
+    elif python_backend == "treesitter":
+        sts = SimpleTreeSitter()
+        sts.set_language("python")
+        sts.set_module(path=filepath)
+
+        # tree-sitter recovers from syntax errors, LibCST decides whether the file is usable
+        if sts.module.root_node.has_error:
+            raise SyntaxError("tree-sitter could not parse the file")
+
+        return sts
+
+    simple_cst = SimpleCST()
+    simple_cst.set_module(filepath=filepath)
+
+    return simple_cst
+
+
+# Returns a generator of the function records of a single file
+def iter_file_functions(filepath, python_backend="libcst"):
+    if filepath.endswith(".py"):
+        try:
+            parser = _get_python_parser(filepath, python_backend)
+        except Exception as e:
+            if python_backend == "libcst":
+                raise
+
+            print("fileparser: falling back to LibCST for ", filepath, e)
+            parser = _get_python_parser(filepath, "libcst")
+
+        return parser.iter_functions()
+
+    # Using TreeSitter
+    elif filepath.endswith(".js"):
+        sts = SimpleTreeSitter()
+        sts.set_language("javascript")
+        sts.set_module(path=filepath)
+
+        return sts.iter_functions()
+
+    return iter([])
+
+
+def parse_file(filepath, python_backend="libcst"):
+    return list(iter_file_functions(filepath, python_backend))
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("Parsing took too long")
+
+
+# Runs in the worker processes
+def _parse_file_with_timeout(filepath, timeout, python_backend):
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    try:
+        return parse_file(filepath, python_backend)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ParallelParser(object):
+    def __init__(self, num_workers, timeout, max_file_bytes, python_backend="ast"):
+        assert python_backend in PYTHON_BACKENDS, "Unknown python backend: {}".format(
+            python_backend
+        )
+
+        if num_workers == "auto":
+            num_workers = len(os.sched_getaffinity(0))
+
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.max_file_bytes = max_file_bytes
+        self.python_backend = python_backend
+        self.max_pending = 4 * num_workers
+
+        self.mp_context = multiprocessing.get_context("forkserver")
+        self.mp_context.set_forkserver_preload([__name__])
+
+    def _is_too_large(self, filepath):
+        if os.path.getsize(filepath) > self.max_file_bytes:
+            print("ParallelParser: skipping large file ", filepath)
+            return True
+
+        return False
+
+    # Yields (filepath, func_list) in completion order, files that are skipped or fail are not yielded
+    def parse_files(self, filepaths):
+        if self.num_workers == 0:
+            yield from self._parse_files_inline(filepaths)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=self.mp_context,
+        ) as executor:
+            pending = {}
+
+            for filepath in filepaths:
+                if self._is_too_large(filepath):
+                    continue
+
+                future = executor.submit(
+                    _parse_file_with_timeout,
+                    filepath,
+                    self.timeout,
+                    self.python_backend,
+                )
+                pending[future] = filepath
+
+                if len(pending) >= self.max_pending:
+                    yield from self._collect(pending)
+
+            while pending:
+                yield from self._collect(pending)
+
+    def _collect(self, pending):
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            filepath = pending.pop(future)
+
+            try:
+                yield filepath, future.result()
+            except Exception as e:
+                print("Error in ParallelParser.parse_files: ", filepath, e)
+
+    # func_list is a generator here, a file failing part way through keeps the functions already yielded
+    def _parse_files_inline(self, filepaths):
+        for filepath in filepaths:
+            if self._is_too_large(filepath):
+                continue
+
+            try:
+                functions = iter_file_functions(filepath, self.python_backend)
+            except Exception as e:
+                print("Error in ParallelParser.parse_files: ", filepath, e)
+                continue
+
+            yield filepath, self._guard(filepath, functions)
+
+    def _guard(self, filepath, functions):
+        try:
+            yield from functions
+        except Exception as e:
+            print("Error in ParallelParser.parse_files: ", filepath, e)
+
+
+# Parses every .py file under `path` in-process with each backend, reporting throughput and how many
+# (function name, class name, line) records agree with LibCST
+def benchmark(path, max_files=None):
+    filepaths = []
+    for root, _, files in os.walk(path):
+        filepaths.extend(os.path.join(root, f) for f in files if f.endswith(".py"))
+    filepaths = sorted(filepaths)[:max_files]
+    num_bytes = sum(os.path.getsize(filepath) for filepath in filepaths)
+
+    print("Corpus: {} files, {:.1f} MB".format(len(filepaths), num_bytes / 1000000))
+
+    results = {}
+    for python_backend in ("libcst", "treesitter", "ast"):
+        records = {}
+        num_failed = 0
+
+        start_time = time.perf_counter()
+        for filepath in filepaths:
+            try:
+                records[filepath] = [
+                    (
+                        func["func_name"],
+                        func["class_name"],
+                        int(func["line_number"]),
+                    )
+                    for func in parse_file(filepath, python_backend)
+                ]
+            except Exception:
+                num_failed += 1
+        elapsed = time.perf_counter() - start_time
+
+        results[python_backend] = records
+        num_functions = sum(len(functions) for functions in records.values())
+        num_matching = sum(
+            len(set(functions) & set(results["libcst"].get(filepath, [])))
+            for filepath, functions in records.items()
+        )
+
+        print(
+            "{}: {:.2f} s, {:.2f} MB/s, {} functions, {:.1%} matching LibCST, {} failed".format(
+                python_backend,
+                elapsed,
+                num_bytes / 1000000 / max(elapsed, 1e-9),
+                num_functions,
+                num_matching / max(num_functions, 1),
+                num_failed,
+            )
+        )
+
+
+if __name__ == "__main__":
+    # Usage: python -m codesearch.utils.fileparser [corpus_dir] [max_files]
+    # Without arguments the standard library of the running interpreter is used as the corpus
+    benchmark(
+        path=sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.__file__),
+        max_files=int(sys.argv[2]) if len(sys.argv) > 2 else None,
+    )
@@ -0,0 +1,373 @@
+import os
+import re
+import sys
+import time
+
+## Notes:
+# 1.) FileWalker walks a project with os.scandir and yields the source files to index. Directories are matched
+#     against the ignore rules before they are entered, so node_modules, .git, virtualenvs, build output etc.
+#     are never listed
+# 2.) Rules are in gitignore syntax (later rules win, ! re-includes, a trailing / matches directories only,
+#     a pattern with a / is relative to the directory of its file):
+#   - excluded: walker.exclude in config.yaml, relative to the project root
+#   - gitignore: the .gitignore files of the project and .git/info/exclude, with walker.gitignore
+# 3.) walker.include restricts indexing to the files matching one of its patterns (e.g. src/), an empty list
+#     indexes every source file. It does not re-include excluded or ignored files
+# 4.) Files are skipped by heuristics, reading at most SNIFF_BYTES of them:
+#   - too_large: larger than parsing.max_file_bytes
+#   - minified: the average line length is above walker.max_line_length (as GitHub Linguist does)
+#   - generated: a generated code marker (GENERATED_MARKERS) in the first HEADER_BYTES
+#   Directories with a pyvenv.cfg are virtualenvs, whatever their name
+# 5.) WalkReport counts the skipped files and bytes per reason. Pruned directories are counted as directories,
+#     their content is never listed
+# 6.) Symlinked directories are not followed (like os.walk)
+
+SNIFF_BYTES = 8192
+HEADER_BYTES = 1024
+GENERATED_MARKERS = (
+    b"@generated",
+    b"DO NOT EDIT",
+    b"Code generated by",
+    b"Generated by the protocol buffer compiler",
+    b"auto-generated",
+    b"autogenerated",
+    b"/******/",  # webpack bundles
+)
+
+
+# Translates a gitignore glob (without its leading / trailing slashes) into a regex
+def _translate(pattern):
+    regex = ""
+    i = 0
+
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[":
+            j = i + 1
+            if j < len(pattern) and pattern[j] in "!^":
+                j += 1
+            if j < len(pattern) and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+
+            if j == -1:
+                regex += "\\["
+                i += 1
+            else:
+                body = pattern[i + 1 : j].replace("\\", "\\\\")
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                regex += "[" + body + "]"
+                i = j + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+
+    return regex
+
+
+class IgnoreRule(object):
+    def __init__(self, regex, negate, dir_only):
+        self.regex = regex
+        self.negate = negate
+        self.dir_only = dir_only
+
+
+# Returns the IgnoreRule of a gitignore line, None for blank lines and comments.
+# base is the directory of the rule's file, relative to the project root ("" for the root).
+def parse_rule(line, base=""):
+    line = line.rstrip("\r\n").rstrip(" ")
+    if not line or line.startswith("#"):
+        return None
+
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+
+    # A pattern with a slash is relative to the base directory, one without matches at any depth
+    prefix = re.escape(base + "/") if base else ""
+    if "/" not in line:
+        prefix += "(?:.*/)?"
+
+    return IgnoreRule(
+        regex=re.compile(prefix + _translate(line.lstrip("/")) + "$", re.DOTALL),
+        negate=negate,
+        dir_only=dir_only,
+    )
+
+
+def parse_rules(lines, base=""):
+    rules = (parse_rule(line, base) for line in lines)
+
+    return tuple(rule for rule in rules if rule is not None)
+
+
+# True if the last rule matching the path (relative to the project root, / separated) does not negate
+def is_ignored(rules, path, is_dir):
+    ignored = False
+
+    for rule in rules:
+        if rule.dir_only and not is_dir:
+            continue
+        if rule.regex.match(path):
+            ignored = not rule.negate
+
+    return ignored
+
+
+def _read_rules(filepath, base):
+    try:
+        with open(filepath, encoding="utf-8", errors="ignore") as f:
+            return parse_rules(f.read().splitlines(), base)
+    except OSError:
+        return ()
+
+
+class WalkReport(object):
+    def __init__(self, stats=None):
+        self.files = 0
+        self.bytes = 0
+        self.skipped = {}  # reason -> {"dirs", "files", "bytes"}
+        self.stats = stats  # IndexingStats of the job, for its progress
+        self.start_time = time.monotonic()
+        self.end_time = None
+
+    def _get_reason(self, reason):
+        return self.skipped.setdefault(reason, {"dirs": 0, "files": 0, "bytes": 0})
+
+    def add_file(self, size):
+        self.files += 1
+        self.bytes += size
+
+    def skip_dir(self, reason):
+        self._get_reason(reason)["dirs"] += 1
+
+    def skip_file(self, reason, size):
+        skipped = self._get_reason(reason)
+        skipped["files"] += 1
+        skipped["bytes"] += size
+
+        if self.stats is not None:
+            self.stats.add("files_skipped", 1)
+            self.stats.add("bytes_skipped", size)
+
+    def get_skipped_files(self):
+        return sum(skipped["files"] for skipped in self.skipped.values())
+
+    def get_skipped_bytes(self):
+        return sum(skipped["bytes"] for skipped in self.skipped.values())
+
+    def to_dict(self):
+        return {reason: dict(skipped) for reason, skipped in self.skipped.items()}
+
+    def __str__(self):
+        end_time = self.end_time if self.end_time is not None else time.monotonic()
+
+        return "files: {}, bytes: {}, skipped files: {}, skipped bytes: {}, elapsed: {:.2f}s, {}".format(
+            self.files,
+            self.bytes,
+            self.get_skipped_files(),
+            self.get_skipped_bytes(),
+            end_time - self.start_time,
+            ", ".join(
+                "{}: {} dirs / {} files / {} bytes".format(
+                    reason, skipped["dirs"], skipped["files"], skipped["bytes"]
+                )
+                for reason, skipped in sorted(self.skipped.items())
+            ),
+        )
+
+
+class FileWalker(object):
+    def __init__(
+        self,
+        extensions,
+        exclude=(),
+        include=(),
+        gitignore=True,
+        max_file_bytes=2000000,
+        max_line_length=110,
+    ):
+        self.extensions = tuple(extensions)
+        self.exclude_rules = parse_rules(exclude)
+        self.include_rules = parse_rules(include)
+        self.gitignore = gitignore
+        self.max_file_bytes = max_file_bytes
+        self.max_line_length = max_line_length
+
+    # Returns the reason to skip the file from its first bytes, None to index it
+    def _sniff(self, filepath):
+        try:
+            with open(filepath, "rb") as f:
+                data = f.read(SNIFF_BYTES)
+        except OSError:
+            return "unreadable"
+
+        if any(marker in data[:HEADER_BYTES] for marker in GENERATED_MARKERS):
+            return "generated"
+
+        lines = data.splitlines()
+        if lines and len(data) / len(lines) > self.max_line_length:
+            return "minified"
+
+        return None
+
+    # True if the file or one of its directories matches walker.include (or the list is empty)
+    def _is_included(self, path):
+        if not self.include_rules:
+            return True
+
+        parts = path.split("/")
+        for depth in range(1, len(parts)):
+            if is_ignored(self.include_rules, "/".join(parts[:depth]), True):
+                return True
+
+        return is_ignored(self.include_rules, path, False)
+
+    # Returns the reason to skip the entry, None to keep it. path is relative to the project root.
+    def _get_skip_reason(self, path, is_dir, rules):
+        if is_ignored(self.exclude_rules, path, is_dir):
+            return "excluded"
+        if is_ignored(rules, path, is_dir):
+            return "gitignore"
+
+        return None
+
+    # Yields the paths (project_path joined with the relative path) of the files to index
+    def walk(self, project_path, report=None):
+        report = report if report is not None else WalkReport()
+
+        rules = ()
+        if self.gitignore:
+            rules = _read_rules(
+                os.path.join(project_path, ".git", "info", "exclude"), ""
+            )
+
+        stack = [(project_path, "", rules)]
+        while stack:
+            dirpath, base, rules = stack.pop()
+
+            try:
+                with os.scandir(dirpath) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError:
+                report.skip_dir("unreadable")
+                continue
+
+            names = set(entry.name for entry in entries)
+            if base and "pyvenv.cfg" in names:
+                report.skip_dir("virtualenv")
+                continue
+            if self.gitignore and ".gitignore" in names:
+                rules = rules + _read_rules(os.path.join(dirpath, ".gitignore"), base)
+
+            subdirs = []
+            for entry in entries:
+                path = base + "/" + entry.name if base else entry.name
+
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    is_file = not is_dir and entry.is_file()
+                except OSError:
+                    continue
+
+                if is_dir:
+                    reason = self._get_skip_reason(path, True, rules)
+                    if reason is not None:
+                        report.skip_dir(reason)
+                    else:
+                        subdirs.append((entry.path, path, rules))
+                    continue
+
+                if not is_file:
+                    continue
+
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    report.skip_file("unreadable", 0)
+                    continue
+
+                if not entry.name.endswith(self.extensions):
+                    report.skip_file("not_source", size)
+                    continue
+
+                reason = self._get_skip_reason(path, False, rules)
+                if reason is None and not self._is_included(path):
+                    reason = "not_included"
+                if reason is None and size > self.max_file_bytes:
+                    reason = "too_large"
+                if reason is None:
+                    reason = self._sniff(entry.path)
+
+                if reason is not None:
+                    report.skip_file(reason, size)
+                else:
+                    report.add_file(size)
+                    yield entry.path
+
+            # Depth first in name order
+            stack.extend(reversed(subdirs))
+
+        report.end_time = time.monotonic()
+
+
+# Compares the walker with a plain os.walk over the source files of `path`
+def benchmark(path, extensions=(".py", ".js"), exclude=(), include=()):
+    start_time = time.perf_counter()
+    num_files, num_bytes = 0, 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            if file.endswith(extensions):
+                num_files += 1
+                num_bytes += os.path.getsize(os.path.join(root, file))
+    elapsed = time.perf_counter() - start_time
+    print(
+        "os.walk: {} source files, {} bytes, {:.2f}s".format(
+            num_files, num_bytes, elapsed
+        )
+    )
+
+    report = WalkReport()
+    walker = FileWalker(extensions=extensions, exclude=exclude, include=include)
+    for _ in walker.walk(path, report=report):
+        pass
+    print("FileWalker: {}".format(report))
+    print(
+        "{:.1f}x fewer files, {:.1f}x fewer bytes to parse".format(
+            num_files / max(report.files, 1), num_bytes / max(report.bytes, 1)
+        )
+    )
+
+
+if __name__ == "__main__":
+    # Usage: python -m codesearch.utils.filewalker <path> (uses walker.exclude / include of config.yaml)
+    import yaml
+
+    with open("./config.yaml", "r") as stream:
+        configs = yaml.safe_load(stream)
+
+    benchmark(
+        path=sys.argv[1],
+        exclude=configs["walker"]["exclude"],
+        include=configs["walker"]["include"],
+    )
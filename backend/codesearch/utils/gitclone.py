@@ -0,0 +1,232 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+## Notes:
+# 1.) Bounded clone of a public repository, without ever walking the clone to measure it
+#   - git clone --depth 1 --single-branch --filter=blob:limit=<max_blob_bytes> --no-checkout: only the last commit
+#     of the default branch, without blobs larger than max_blob_bytes (the parser skips such files anyway).
+#     The transfer is followed on git's progress output and stopped as soon as it exceeds max_bytes
+#   - the sizes of the source blobs of HEAD are summed from the object database (git cat-file --batch-check)
+#   - only those source files are written to the working tree (git read-tree + checkout-index), so git never
+#     fetches the filtered out blobs on demand
+# 2.) Servers without partial clone support send every blob (uploadpack.allowFilter must be set for file:// repos),
+#     the transfer cap still applies
+# 3.) Runs in the calling thread (an encode / re-index job), git is killed after `timeout` seconds.
+#     GIT_TERMINAL_PROMPT=0 makes private or missing repositories fail instead of waiting for credentials
+# 4.) The .gitignore files are checked out with the source files, so the FileWalker honors them in clones too
+# 5.) Raises CloneTooLargeError / CloneError, the clone directory is removed on failure
+
+PROGRESS_PATTERN = re.compile(r"Receiving objects:.*?, ([0-9.]+) (bytes|KiB|MiB|GiB)")
+UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+CHECKOUT_NAMES = (".gitignore",)
+
+
+class CloneError(Exception):
+    pass
+
+
+class CloneTooLargeError(CloneError):
+    pass
+
+
+def _get_env():
+    env = dict(os.environ)
+    env["GIT_TERMINAL_PROMPT"] = "0"
+
+    return env
+
+
+def _git(project_path, args, input=None):
+    return subprocess.run(
+        ["git", "-C", project_path] + args,
+        input=input,
+        capture_output=True,
+        check=True,
+        env=_get_env(),
+    ).stdout
+
+
+# Runs git clone, following the received bytes on its progress output. Returns the received bytes.
+def _run_clone(command, max_bytes, timeout):
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=_get_env()
+    )
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+
+    received_bytes = 0
+    too_large = False
+    last_lines = deque(maxlen=10)
+    pending = ""
+
+    try:
+        while True:
+            chunk = process.stderr.read1(4096)
+            if not chunk:
+                break
+
+            # Progress updates end with \r, other messages with \n
+            lines = re.split(r"[\r\n]", pending + chunk.decode("utf-8", "replace"))
+            pending = lines.pop()
+
+            for line in lines:
+                if line.strip():
+                    last_lines.append(line.strip())
+
+                match = PROGRESS_PATTERN.search(line)
+                if match:
+                    received_bytes = float(match.group(1)) * UNITS[match.group(2)]
+
+            if received_bytes > max_bytes and not too_large:
+                too_large = True
+                process.kill()
+    finally:
+        process.wait()
+        timer.cancel()
+
+    if too_large:
+        raise CloneTooLargeError(
+            "Clone stopped after {} bytes (limit {})".format(
+                int(received_bytes), max_bytes
+            )
+        )
+    if timed_out.is_set():
+        raise CloneError("Clone timed out after {} seconds".format(timeout))
+    if process.returncode != 0:
+        raise CloneError("git clone failed: {}".format(" | ".join(last_lines)))
+
+    return int(received_bytes)
+
+
+# Returns [(path, oid)] of the source (and .gitignore) files of HEAD whose blobs were received
+def _get_source_blobs(project_path, extensions):
+    missing = set(
+        line[1:]
+        for line in _git(
+            project_path, ["rev-list", "--objects", "--missing=print", "HEAD"]
+        )
+        .decode()
+        .splitlines()
+        if line.startswith("?")
+    )
+
+    blobs = []
+    for entry in _git(project_path, ["ls-tree", "-r", "-z", "HEAD"]).split(b"\0"):
+        if not entry:
+            continue
+
+        info, path = entry.split(b"\t", 1)
+        mode, object_type, oid = info.decode().split(" ")
+        path = path.decode("utf-8", "surrogateescape")
+
+        # Symlinks and submodules are not source files
+        if object_type != "blob" or mode == "120000":
+            continue
+        if oid in missing:
+            continue
+        if path.endswith(extensions) or os.path.basename(path) in CHECKOUT_NAMES:
+            blobs.append((path, oid))
+
+    return blobs, len(missing)
+
+
+def _get_blob_bytes(project_path, oids):
+    if not oids:
+        return 0
+
+    output = _git(
+        project_path, ["cat-file", "--batch-check"], input="\n".join(oids).encode()
+    )
+
+    return sum(int(line.split()[2]) for line in output.decode().splitlines())
+
+
+# Clones `url` into project_path (which must not exist) with only the source files (extensions) checked out.
+# Returns the clone stats, raises CloneTooLargeError when the transfer or the source files exceed max_bytes.
+def clone_repository(url, project_path, max_bytes, max_blob_bytes, extensions, timeout):
+    start_time = time.monotonic()
+
+    try:
+        received_bytes = _run_clone(
+            [
+                "git",
+                "clone",
+                "--depth",
+                "1",
+                "--single-branch",
+                "--filter=blob:limit={}".format(max_blob_bytes),
+                "--no-checkout",
+                "--progress",
+                url,
+                project_path,
+            ],
+            max_bytes=max_bytes,
+            timeout=timeout,
+        )
+
+        blobs, num_filtered = _get_source_blobs(project_path, tuple(extensions))
+        source_bytes = _get_blob_bytes(project_path, [oid for _, oid in blobs])
+
+        if source_bytes > max_bytes:
+            raise CloneTooLargeError(
+                "Source files are {} bytes (limit {})".format(source_bytes, max_bytes)
+            )
+
+        _git(project_path, ["read-tree", "HEAD"])
+        _git(
+            project_path,
+            ["checkout-index", "-z", "--stdin"],
+            input=b"\0".join(
+                path.encode("utf-8", "surrogateescape") for path, _ in blobs
+            ),
+        )
+    except subprocess.CalledProcessError as e:
+        shutil.rmtree(project_path, ignore_errors=True)
+        raise CloneError(
+            "{} failed: {}".format(
+                " ".join(e.cmd[3:5]), e.stderr.decode(errors="replace").strip()
+            )
+        )
+    except Exception:
+        shutil.rmtree(project_path, ignore_errors=True)
+        raise
+
+    return {
+        "received_bytes": received_bytes,
+        "source_files": len(blobs),
+        "source_bytes": source_bytes,
+        "filtered_blobs": num_filtered,
+        "clone_time_s": time.monotonic() - start_time,
+    }
+
+
+if __name__ == "__main__":
+    # Usage: python -m codesearch.utils.gitclone <url> <project_path> [max_bytes]
+    # e.g. a local bare repository: git clone --bare <repo> /tmp/repo.git
+    #                               git -C /tmp/repo.git config uploadpack.allowFilter true
+    #                               python -m codesearch.utils.gitclone file:///tmp/repo.git /tmp/clone
+    try:
+        print(
+            clone_repository(
+                url=sys.argv[1],
+                project_path=sys.argv[2],
+                max_bytes=int(sys.argv[3]) if len(sys.argv) > 3 else 100000000,
+                max_blob_bytes=2000000,
+                extensions=(".py", ".js"),
+                timeout=300,
+            )
+        )
+    except CloneError as e:
+        print("Error in gitclone: ", e)
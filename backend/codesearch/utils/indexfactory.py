@@ -0,0 +1,529 @@
+import math
+import sys
+import time
+
+import faiss
+import numpy as np
+
+## Notes:
+# 1.) Builds the per-project FAISS index from the "index" section of config.yaml
+#   - type: flat, ivf_flat, ivf_pq, hnsw, or auto (picked from the number of vectors using index.auto)
+#   - IVF indexes are trained on a random sample of at most index.train_sample_size vectors
+# 2.) Every index is wrapped in an IndexIDMap2, so search returns ids of the embeddings table rows
+# 3.) nprobe / efSearch are passed per search as SearchParameters, so concurrent searches with
+#     different settings never change the shared index. They also carry the ID selector of filtered searches.
+# 4.) get_recall_report() compares index settings on held-out vectors against exact search
+# 5.) index.compression shrinks the vectors kept in the index (ivf_pq is always compressed):
+#   - codec: none, fp16 / sq8 (scalar quantization, 2 / 1 bytes per dimension), pq (pq_m x pq_nbits bits per vector)
+#   - reduction: none, pca (PCA projection) or matryoshka (first reduced_dimension dimensions, renormalized,
+#     only for models trained for it, e.g. text-embedding-3), applied before the codec
+#   Compressed indexes return rerank_factor * k candidates which are re-ranked with the full vectors of the
+#   embeddings table (see rerank()), so the index does not need to keep them in memory
+# 6.) get_compression_report() compares the memory and recall of the compression settings
+# 7.) A flat index with the pq codec is an IVF index with a single list ("IVF1,PQ..."): it scans every vector
+#     like IndexPQ, which rejects SearchParameters and so could not run filtered searches.
+#     check_search_parameters() searches every type / codec / reduction with and without a selector.
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+CODECS = ("none", "fp16", "sq8", "pq")
+REDUCTIONS = ("none", "pca", "matryoshka")
+NO_COMPRESSION = {"codec": "none", "reduction": "none", "reduced_dimension": 0}
+
+
+def get_index_type(num_vectors, index_configs):
+    if index_configs["type"] != "auto":
+        return index_configs["type"]
+
+    for rule in index_configs["auto"]:
+        if "max_size" not in rule or num_vectors < rule["max_size"]:
+            return rule["type"]
+
+    return "flat"
+
+
+def get_nlist(num_vectors, index_configs):
+    if index_configs["nlist"] != "auto":
+        return index_configs["nlist"]
+
+    # FAISS guideline is 4 * sqrt(n) lists, with at least 39 training points per list
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def get_pq_string(dimension, index_configs):
+    pq_m = index_configs["pq_m"]
+    assert (
+        dimension % pq_m == 0
+    ), "index.pq_m ({}) must divide the dimension ({})".format(pq_m, dimension)
+
+    return "PQ{}x{}".format(pq_m, index_configs["pq_nbits"])
+
+
+# Storage of the vectors in flat, ivf_flat and hnsw indexes
+def get_codec_string(codec, dimension, index_configs):
+    if codec == "none":
+        return "Flat"
+    elif codec == "fp16":
+        return "SQfp16"
+    elif codec == "sq8":
+        return "SQ8"
+    elif codec == "pq":
+        return get_pq_string(dimension, index_configs)
+
+    raise Exception("Unknown codec: {}".format(codec))
+
+
+def get_factory_string(index_type, num_vectors, dimension, index_configs, codec="none"):
+    codec_string = get_codec_string(codec, dimension, index_configs)
+
+    if index_type == "flat":
+        if codec == "pq":
+            return "IVF1,{}".format(codec_string)
+
+        return codec_string
+    elif index_type == "ivf_flat":
+        return "IVF{},{}".format(get_nlist(num_vectors, index_configs), codec_string)
+    elif index_type == "ivf_pq":
+        return "IVF{},{}".format(
+            get_nlist(num_vectors, index_configs),
+            get_pq_string(dimension, index_configs),
+        )
+    elif index_type == "hnsw":
+        if codec == "none":
+            return "HNSW{}".format(index_configs["hnsw_m"])
+
+        return "HNSW{},{}".format(index_configs["hnsw_m"], codec_string)
+
+    raise Exception("Unknown index type: {}".format(index_type))
+
+
+# Dimension reduction applied to the vectors before they are indexed, None for none
+def get_reduction_transforms(reduction, dimension, reduced_dimension):
+    if reduction == "none" or reduced_dimension >= dimension:
+        return None
+    elif reduction == "pca":
+        return [faiss.PCAMatrix(dimension, reduced_dimension)]
+    elif reduction == "matryoshka":
+        return [
+            faiss.RemapDimensionsTransform(dimension, reduced_dimension, False),
+            faiss.NormalizationTransform(reduced_dimension, 2.0),
+        ]
+
+    raise Exception("Unknown dimension reduction: {}".format(reduction))
+
+
+def _get_training_sample(embeddings, sample_size):
+    if len(embeddings) <= sample_size:
+        return np.ascontiguousarray(embeddings)
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(embeddings), size=sample_size, replace=False)
+
+    return np.ascontiguousarray(embeddings[np.sort(sample)])
+
+
+# Returns a CPU index holding `embeddings` under `ids`. compression defaults to index.compression.
+def build_index(
+    embeddings, ids, dimension, index_configs, index_type=None, compression=None
+):
+    num_vectors = len(embeddings)
+
+    if index_type is None:
+        index_type = get_index_type(num_vectors, index_configs)
+
+    if compression is None:
+        compression = index_configs["compression"]
+
+    codec = compression["codec"]
+    reduction = compression["reduction"]
+
+    # Small projects do not have enough vectors to train the coarse quantizer / PQ codebooks
+    if index_type == "ivf_flat" and num_vectors < 39:
+        index_type = "flat"
+    elif index_type == "ivf_pq" and num_vectors < 2 ** index_configs["pq_nbits"]:
+        index_type = "flat"
+
+    # ... nor the scalar quantizer, PQ codebooks or PCA matrix of a compressed index
+    if codec == "pq" and num_vectors < 2 ** index_configs["pq_nbits"]:
+        codec = "sq8"
+    if reduction == "pca" and num_vectors < compression["reduced_dimension"]:
+        reduction = "none"
+    if num_vectors == 0:
+        codec, reduction = "none", "none"
+
+    transforms = get_reduction_transforms(
+        reduction, dimension, compression["reduced_dimension"]
+    )
+    index_dimension = compression["reduced_dimension"] if transforms else dimension
+
+    factory_string = get_factory_string(
+        index_type, num_vectors, index_dimension, index_configs, codec=codec
+    )
+    index = faiss.index_factory(
+        index_dimension, factory_string, faiss.METRIC_INNER_PRODUCT
+    )
+
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = index_configs["hnsw_ef_construction"]
+
+    if transforms:
+        index = faiss.IndexPreTransform(transforms[-1], index)
+        for transform in reversed(transforms[:-1]):
+            index.prepend_transform(transform)
+
+    if not index.is_trained:
+        index.train(
+            _get_training_sample(embeddings, index_configs["train_sample_size"])
+        )
+
+    index = faiss.IndexIDMap2(index)
+
+    if num_vectors > 0:
+        index.add_with_ids(embeddings, ids)
+
+    return index
+
+
+# Index wrapped in the IndexIDMap2 (and the IndexPreTransform of a dimension reduction)
+def get_sub_index(index):
+    sub_index = faiss.downcast_index(index.index)
+
+    if isinstance(sub_index, faiss.IndexPreTransform):
+        sub_index = faiss.downcast_index(sub_index.index)
+
+    return sub_index
+
+
+# True when the index does not keep the full vectors (their scores are approximate)
+def is_compressed(index):
+    if isinstance(faiss.downcast_index(index.index), faiss.IndexPreTransform):
+        return True
+
+    sub_index = get_sub_index(index)
+
+    if isinstance(sub_index, faiss.IndexHNSW):
+        sub_index = faiss.downcast_index(sub_index.storage)
+
+    return not isinstance(sub_index, (faiss.IndexFlat, faiss.IndexIVFFlat))
+
+
+# Re-ranks candidate ids (rows of an index search, -1 for none) with exact inner products.
+# ids / vectors are the full vectors of the candidates (ids sorted, candidates without a vector are dropped).
+# Returns (D, I) of the top k of every query.
+def rerank(query_embeddings, candidate_ids, ids, vectors, k):
+    if len(ids) == 0:
+        return (
+            np.full((len(query_embeddings), k), -np.inf, dtype="float32"),
+            np.full((len(query_embeddings), k), -1, dtype="int64"),
+        )
+
+    rows = np.minimum(np.searchsorted(ids, candidate_ids), len(ids) - 1)
+    scores = np.einsum("qd,qcd->qc", query_embeddings, vectors[rows])
+    scores[(candidate_ids < 0) | (ids[rows] != candidate_ids)] = -np.inf
+
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    D = np.take_along_axis(scores, order, axis=1).astype("float32")
+    I = np.take_along_axis(candidate_ids, order, axis=1)
+    I[np.isneginf(D)] = -1
+
+    return D, I
+
+
+# Search parameters for the index wrapped in the IndexIDMap2, None for exact indexes without a selector.
+# sel (an IDSelector on the ids of the IndexIDMap2) restricts the search to the selected ids.
+def get_search_parameters(index, index_configs, nprobe=None, ef_search=None, sel=None):
+    sub_index = get_sub_index(index)
+
+    if isinstance(sub_index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(
+            nprobe=nprobe if nprobe is not None else index_configs["nprobe"],
+            sel=sel,
+        )
+    elif isinstance(sub_index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(
+            efSearch=ef_search if ef_search is not None else index_configs["ef_search"],
+            sel=sel,
+        )
+    elif sel is not None:
+        return faiss.SearchParameters(sel=sel)
+
+    return None
+
+
+def get_index_bytes(index):
+    return faiss.serialize_index(index).nbytes
+
+
+def _evaluate(index, queries, ground_truth, k, params):
+    latencies = []
+    hits = 0
+
+    for i in range(len(queries)):
+        start_time = time.perf_counter()
+        _, I = index.search(queries[i : i + 1], k, params=params)
+        latencies.append(time.perf_counter() - start_time)
+
+        hits += len(np.intersect1d(I[0], ground_truth[i]))
+
+    latencies = np.array(latencies) * 1000
+
+    return {
+        "recall": hits / float(ground_truth.size),
+        "latency_ms_mean": float(latencies.mean()),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+    }
+
+
+# Builds every index type on `embeddings` minus `num_queries` held-out vectors, then measures
+# recall@k (against exact search) and single query latency for each nprobe / efSearch setting
+def get_recall_report(embeddings, index_configs, num_queries, k, nprobe, ef_search):
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    rng = np.random.default_rng(0)
+    permutation = rng.permutation(len(embeddings))
+
+    queries = embeddings[permutation[:num_queries]]
+    base = np.ascontiguousarray(embeddings[permutation[num_queries:]])
+    ids = np.arange(len(base), dtype="int64")
+    dimension = embeddings.shape[1]
+
+    exact_index = build_index(
+        base,
+        ids,
+        dimension,
+        index_configs,
+        index_type="flat",
+        compression=NO_COMPRESSION,
+    )
+    _, ground_truth = exact_index.search(queries, k)
+
+    report = []
+    for index_type in INDEX_TYPES:
+        start_time = time.perf_counter()
+        try:
+            index = build_index(
+                base,
+                ids,
+                dimension,
+                index_configs,
+                index_type=index_type,
+                compression=NO_COMPRESSION,
+            )
+        except Exception as e:
+            print("Error in indexfactory.get_recall_report: ", index_type, e)
+            continue
+        build_time = time.perf_counter() - start_time
+
+        sub_index = faiss.downcast_index(index.index)
+        if isinstance(sub_index, faiss.IndexIVF):
+            settings = [{"nprobe": value} for value in nprobe]
+        elif isinstance(sub_index, faiss.IndexHNSW):
+            settings = [{"ef_search": value} for value in ef_search]
+        else:
+            settings = [{}]
+
+        for setting in settings:
+            params = get_search_parameters(index, index_configs, **setting)
+            result = _evaluate(index, queries, ground_truth, k, params)
+            result.update(setting)
+            result.update(
+                {
+                    "type": index_type,
+                    "index_class": type(sub_index).__name__,
+                    "build_time_s": build_time,
+                    "index_bytes": get_index_bytes(index),
+                }
+            )
+            report.append(result)
+
+    return report
+
+
+# Memory and dimension of a project's index
+def get_index_summary(index):
+    index_bytes = get_index_bytes(index)
+
+    return {
+        "index_class": type(get_sub_index(index)).__name__,
+        "compressed": is_compressed(index),
+        "num_vectors": int(index.ntotal),
+        "dimension": int(index.d),
+        "index_dimension": int(get_sub_index(index).d),
+        "index_bytes": index_bytes,
+        "bytes_per_vector": index_bytes / max(int(index.ntotal), 1),
+    }
+
+
+# Builds the index picked for the project size (index.type) with every codec / reduction on `embeddings`
+# minus `num_queries` held-out vectors, then measures its memory and recall@k against exact search,
+# without and with re-ranking of index.compression.rerank_factor * k candidates by their full vectors
+def get_compression_report(
+    embeddings, index_configs, num_queries, k, codecs, reductions
+):
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    rng = np.random.default_rng(0)
+    permutation = rng.permutation(len(embeddings))
+
+    queries = embeddings[permutation[:num_queries]]
+    base = np.ascontiguousarray(embeddings[permutation[num_queries:]])
+    ids = np.arange(len(base), dtype="int64")
+    dimension = embeddings.shape[1]
+    index_type = get_index_type(len(base), index_configs)
+    rerank_factor = index_configs["compression"]["rerank_factor"]
+
+    exact_index = build_index(
+        base,
+        ids,
+        dimension,
+        index_configs,
+        index_type="flat",
+        compression=NO_COMPRESSION,
+    )
+    _, ground_truth = exact_index.search(queries, k)
+
+    # A reduction to as many dimensions as the embeddings have is no reduction
+    if index_configs["compression"]["reduced_dimension"] >= dimension:
+        reductions = ["none"]
+
+    report = []
+    for reduction in reductions:
+        for codec in codecs:
+            compression = dict(
+                index_configs["compression"], codec=codec, reduction=reduction
+            )
+
+            try:
+                index = build_index(
+                    base,
+                    ids,
+                    dimension,
+                    index_configs,
+                    index_type=index_type,
+                    compression=compression,
+                )
+            except Exception as e:
+                print("Error in indexfactory.get_compression_report: ", codec, e)
+                continue
+
+            params = get_search_parameters(index, index_configs)
+            result = _evaluate(index, queries, ground_truth, k, params)
+
+            # The full vectors of the report are the base vectors, ids are their rows
+            _, candidates = index.search(queries, k * rerank_factor, params=params)
+            _, I = rerank(queries, candidates, ids, base, k)
+            hits = sum(
+                len(np.intersect1d(I[i], ground_truth[i])) for i in range(len(I))
+            )
+
+            result.update(get_index_summary(index))
+            result.update(
+                {
+                    "type": index_type,
+                    "codec": codec,
+                    "reduction": reduction,
+                    "recall_reranked": hits / float(ground_truth.size),
+                    "rerank_factor": rerank_factor,
+                }
+            )
+            report.append(result)
+
+    return report
+
+
+# Builds every index type with every codec / reduction on `embeddings` and searches it with the default
+# parameters and with an ID selector (filtered search). Returns the failing combinations, results of a
+# filtered search outside the selection count as a failure.
+def check_search_parameters(embeddings, index_configs, k):
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    ids = np.arange(len(embeddings), dtype="int64")
+    queries = embeddings[:10]
+    selected = ids[::3]
+    bitmap = np.zeros((len(ids) + 7) // 8, dtype="uint8")
+    bitmap[selected >> 3] |= (1 << (selected & 7)).astype("uint8")
+    sel = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+
+    failures = []
+    for index_type in INDEX_TYPES:
+        for codec in CODECS:
+            for reduction in REDUCTIONS:
+                compression = dict(
+                    index_configs["compression"], codec=codec, reduction=reduction
+                )
+                name = "{} / {} / {}".format(index_type, codec, reduction)
+
+                try:
+                    index = build_index(
+                        embeddings,
+                        ids,
+                        embeddings.shape[1],
+                        index_configs,
+                        index_type=index_type,
+                        compression=compression,
+                    )
+                    index.search(
+                        queries, k, params=get_search_parameters(index, index_configs)
+                    )
+                    _, I = index.search(
+                        queries,
+                        k,
+                        params=get_search_parameters(index, index_configs, sel=sel),
+                    )
+                except Exception as e:
+                    failures.append((name, str(e).splitlines()[0]))
+                    continue
+
+                found = I[I >= 0]
+                if len(found) == 0 or np.any(found % 3 != 0):
+                    failures.append((name, "results outside the selector"))
+
+    return failures
+
+
+if __name__ == "__main__":
+    # Usage:
+    #   python -m codesearch.utils.indexfactory [embeddings.npy]
+    #   python -m codesearch.utils.indexfactory check [embeddings.npy]
+    # Without embeddings a random (normalized) matrix is used
+    import yaml
+
+    with open("./config.yaml", "r") as stream:
+        configs = yaml.safe_load(stream)
+
+    check = len(sys.argv) > 1 and sys.argv[1] == "check"
+    if check:
+        sys.argv.pop(1)
+
+    if len(sys.argv) > 1:
+        embeddings = np.load(sys.argv[1], mmap_mode="r")
+    else:
+        embeddings = np.random.default_rng(0).standard_normal((10000, 128))
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    if check:
+        failures = check_search_parameters(
+            embeddings=embeddings,
+            index_configs=configs["index"],
+            k=configs["model"]["num_nearest_neighbours"],
+        )
+        for name, error in failures:
+            print("{}: {}".format(name, error))
+        print("{} failing combinations".format(len(failures)))
+        sys.exit(1 if failures else 0)
+
+    for result in get_recall_report(
+        embeddings=embeddings,
+        index_configs=configs["index"],
+        num_queries=configs["index"]["report"]["num_queries"],
+        k=configs["model"]["num_nearest_neighbours"],
+        nprobe=configs["index"]["report"]["nprobe"],
+        ef_search=configs["index"]["report"]["ef_search"],
+    ):
+        print(result)
+
+    for result in get_compression_report(
+        embeddings=embeddings,
+        index_configs=configs["index"],
+        num_queries=configs["index"]["report"]["num_queries"],
+        k=configs["model"]["num_nearest_neighbours"],
+        codecs=configs["index"]["report"]["codecs"],
+        reductions=configs["index"]["report"]["reductions"],
+    ):
+        print(result)
@@ -0,0 +1,252 @@
+import queue
+import threading
+import time
+
+from .embeddingprovider import RateLimitError
+from .embeddingcache import get_input_hash
+from .ratelimiter import get_backoff_time
+
+## Notes:
+# 1.) Three stages connected by bounded queues:
+#   - Parser: one thread walking the project, batching (key, encoding string) items with the EmbeddingBatcher
+#   - Embedders: a pool of threads making embedding requests concurrently, sharing one AdaptiveRateLimiter
+#   - Writer: the calling thread, so that all database writes happen on a single thread
+# 2.) Any error (other than rate limits) stops every stage and is re-raised from run()
+# 3.) Rate limited requests are retried with jittered exponential backoff, at most max_retries times
+# 4.) With an EmbeddingCache, cached inputs are looked up before a request and only misses are sent
+#     (and count against the rate limit)
+
+_DONE = object()
+
+
+class IndexingStats(object):
+    def __init__(self):
+        self.files_parsed = 0
+        self.functions_parsed = 0
+        self.functions_embedded = 0
+        self.rows_written = 0
+        self.cache_hits = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+        self.skipped = (
+            {}
+        )  # Skipped files per reason, set once the project is walked (see WalkReport)
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.lock = threading.Lock()
+
+    def add(self, name, value):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def get_elapsed_time(self):
+        end_time = self.end_time if self.end_time is not None else time.monotonic()
+
+        return end_time - self.start_time
+
+    def get_functions_per_sec(self):
+        return self.rows_written / max(self.get_elapsed_time(), 1e-9)
+
+    def __str__(self):
+        return (
+            "files: {}, skipped: {}, parsed: {}, embedded: {}, written: {}, cache hits: {}, requests: {}, "
+            "rate limited: {}, elapsed: {:.1f}s, throughput: {:.1f} functions/sec".format(
+                self.files_parsed,
+                self.files_skipped,
+                self.functions_parsed,
+                self.functions_embedded,
+                self.rows_written,
+                self.cache_hits,
+                self.requests,
+                self.rate_limited,
+                self.get_elapsed_time(),
+                self.get_functions_per_sec(),
+            )
+        )
+
+
+class IndexingPipeline(object):
+    def __init__(
+        self,
+        batcher,
+        rate_limiter,
+        num_workers,
+        queue_size,
+        max_retries,
+        backoff_base,
+        backoff_cap,
+        cache=None,
+    ):
+        self.batcher = batcher
+        self.rate_limiter = rate_limiter
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.cache = cache
+
+    # Blocking put that gives up once the pipeline is stopped, so no stage waits on a dead consumer
+    def _put(self, q, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _parse(self, items, batch_queue, stop_event, errors, stats):
+        try:
+            for batch in self.batcher.batches(items):
+                stats.add("functions_parsed", len(batch))
+
+                if not self._put(batch_queue, batch, stop_event):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            for _ in range(self.num_workers):
+                self._put(batch_queue, _DONE, stop_event)
+
+    def _embed_with_retry(self, batch, stats):
+        tokens = sum(self.batcher.estimate_tokens(input) for _, input in batch)
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            stats.add("requests", 1)
+
+            try:
+                results = self.batcher.embed_batch(batch)
+            except RateLimitError as e:
+                stats.add("rate_limited", 1)
+                self.rate_limiter.on_rate_limited(retry_after=e.retry_after)
+
+                if attempt == self.max_retries:
+                    raise
+
+                backoff_time = get_backoff_time(
+                    attempt=attempt, base=self.backoff_base, cap=self.backoff_cap
+                )
+                print(
+                    "IndexingPipeline: rate limited, retrying in {:.1f}s".format(
+                        max(backoff_time, e.retry_after or 0)
+                    )
+                )
+                time.sleep(backoff_time)
+                continue
+
+            self.rate_limiter.on_success()
+
+            return results
+
+    def _embed_with_cache(self, batch, stats):
+        if self.cache is None:
+            return self._embed_with_retry(batch, stats)
+
+        model = self.batcher.provider.model
+        hashes = [get_input_hash(input) for _, input in batch]
+        cached = self.cache.get_many(model, hashes)
+        stats.add("cache_hits", sum(1 for h in hashes if h in cached))
+
+        misses = [item for item, h in zip(batch, hashes) if h not in cached]
+        embedded = {}
+
+        if misses:
+            results = self._embed_with_retry(misses, stats)
+            embedded = {
+                get_input_hash(input): embedding
+                for (_, input), (_, embedding) in zip(misses, results)
+            }
+            self.cache.put_many(model, embedded)
+
+        return [
+            (key, cached[h] if h in cached else embedded[h])
+            for (key, _), h in zip(batch, hashes)
+        ]
+
+    def _embed(self, batch_queue, result_queue, stop_event, errors, stats):
+        try:
+            while not stop_event.is_set():
+                try:
+                    batch = batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if batch is _DONE:
+                    return
+
+                results = self._embed_with_cache(batch, stats)
+                stats.add("functions_embedded", len(results))
+
+                if not self._put(result_queue, results, stop_event):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            self._put(result_queue, _DONE, stop_event)
+
+    # items: iterable of (key, encoding string), write: callable receiving a list of (key, embedding).
+    # stats can be passed in to follow the progress of a run from another thread.
+    def run(self, items, write, stats=None):
+        if stats is None:
+            stats = IndexingStats()
+        stats.start_time = time.monotonic()
+        batch_queue = queue.Queue(maxsize=self.queue_size)
+        result_queue = queue.Queue(maxsize=self.queue_size)
+        stop_event = threading.Event()
+        errors = []
+
+        threads = [
+            threading.Thread(
+                target=self._parse,
+                args=(items, batch_queue, stop_event, errors, stats),
+                daemon=True,
+            )
+        ]
+        for _ in range(self.num_workers):
+            threads.append(
+                threading.Thread(
+                    target=self._embed,
+                    args=(batch_queue, result_queue, stop_event, errors, stats),
+                    daemon=True,
+                )
+            )
+
+        for thread in threads:
+            thread.start()
+
+        # Writer
+        num_done = 0
+        try:
+            while num_done < self.num_workers and not stop_event.is_set():
+                try:
+                    results = result_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if results is _DONE:
+                    num_done += 1
+                    continue
+
+                write(results)
+                stats.add("rows_written", len(results))
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+
+        for thread in threads:
+            thread.join()
+
+        stats.end_time = time.monotonic()
+        print("IndexingPipeline: ", stats)
+
+        if errors:
+            raise errors[0]
+
+        return stats
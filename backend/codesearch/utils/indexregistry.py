@@ -0,0 +1,186 @@
+import os
+import threading
+from collections import OrderedDict
+
+import faiss
+
+## Notes:
+# 1.) One FAISS index per project (keyed by the embeddings table name), kept in memory and persisted to disk
+# 2.) Memory is bounded by a byte budget, least recently used indexes are evicted first
+# 3.) Evicted indexes are still on disk and are loaded back lazily on the next access
+# 4.) An index is only dropped (memory + disk) when the project's embeddings change, see invalidate()
+# 5.) Several server workers share the files in cache_dir: an index replaced or deleted by another worker
+#     is noticed by its modification time and reloaded. With mmap, indexes are memory mapped read-only, so
+#     the inverted lists of IVF indexes are shared between the workers through the page cache.
+#     Changes are always made on a private copy, see load().
+# 6.) self.lock only guards the in-memory bookkeeping. Indexes are read from disk outside of it, under a lock
+#     per project, so loading a large index does not hold up the searches of the other projects, and
+#     concurrent searches on a cold project wait for a single load.
+# 7.) get(cache=False) is for scans over every project (global search): a cached index is used as is, one that
+#     is not cached is read for the caller only. The LRU order and content are left alone, so a scan does
+#     not evict the indexes of the projects searched one by one.
+
+
+class IndexRegistry(object):
+    def __init__(self, cache_dir, max_bytes, to_device=None, mmap=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        self.to_device = to_device if to_device is not None else (lambda index: index)
+
+        self.indexes = OrderedDict()
+        self.sizes = {}
+        self.mtimes = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_path(self, table_name):
+        return os.path.join(self.cache_dir, "embeddings_{}.index".format(table_name))
+
+    def _to_cpu(self, index):
+        if faiss.get_num_gpus() == 0:
+            return index
+
+        return faiss.index_gpu_to_cpu(index)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.indexes) > 1:
+            table_name, _ = self.indexes.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(table_name)
+            self.mtimes.pop(table_name)
+            print("IndexRegistry: evicted index for embeddings_{}".format(table_name))
+
+    def _remove(self, table_name):
+        if table_name in self.indexes:
+            self.total_bytes -= self.sizes.pop(table_name)
+            self.mtimes.pop(table_name)
+            del self.indexes[table_name]
+
+    # stat is the os.stat of the file the index was read from (or written to). The serialized size is a close
+    # estimate of the resident size for every index type.
+    def _insert(self, table_name, index, stat):
+        self._remove(table_name)
+
+        self.indexes[table_name] = index
+        self.sizes[table_name] = stat.st_size
+        self.mtimes[table_name] = stat.st_mtime
+        self.total_bytes += self.sizes[table_name]
+        self._evict()
+
+    def load_all(self, is_valid):
+        # Called on startup, warms the in-memory cache from disk (bounded by the byte budget).
+        # is_valid(table_name, index) lets the caller drop indexes that no longer match the database.
+        for filename in sorted(os.listdir(self.cache_dir)):
+            if filename.startswith("embeddings_") and filename.endswith(".index"):
+                table_name = filename[len("embeddings_") : -len(".index")]
+                index = self.get(table_name)
+
+                if index is not None and not is_valid(table_name, index):
+                    print(
+                        "IndexRegistry: stale index for embeddings_{}, dropping it".format(
+                            table_name
+                        )
+                    )
+                    self.invalidate(table_name)
+
+    def _get_stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def _get_load_lock(self, table_name):
+        with self.lock:
+            return self.load_locks.setdefault(table_name, threading.Lock())
+
+    # The cached index if it is still the one on disk (same mtime), None otherwise. Callers hold self.lock.
+    def _get_cached(self, table_name, stat, touch=True):
+        if table_name in self.indexes:
+            if stat is not None and self.mtimes[table_name] == stat.st_mtime:
+                if touch:
+                    self.indexes.move_to_end(table_name)
+                return self.indexes[table_name]
+
+            # Replaced or deleted by another worker
+            self._remove(table_name)
+
+        return None
+
+    def _read(self, path):
+        io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if self.mmap else 0
+
+        return self.to_device(faiss.read_index(path, io_flags))
+
+    def get(self, table_name, cache=True):
+        table_name = str(table_name)
+        path = self._get_path(table_name)
+
+        stat = self._get_stat(path)
+        with self.lock:
+            index = self._get_cached(table_name, stat, touch=cache)
+
+        if index is not None or stat is None:
+            return index
+
+        if not cache:
+            try:
+                return self._read(path)
+            except Exception as e:
+                print("Error in IndexRegistry.get: ", e)
+                return None
+
+        with self._get_load_lock(table_name):
+            # Loaded by another thread while this one waited
+            stat = self._get_stat(path)
+            with self.lock:
+                index = self._get_cached(table_name, stat)
+
+            if index is not None or stat is None:
+                return index
+
+            try:
+                index = self._read(path)
+            except Exception as e:
+                print("Error in IndexRegistry.get: ", e)
+                return None
+
+            # A file replaced during the read has a newer mtime, the next get() reloads it
+            with self.lock:
+                self._insert(table_name, index, stat)
+
+            return index
+
+    # A private, writable CPU copy of the persisted index (not cached), None if there is none
+    def load(self, table_name):
+        path = self._get_path(str(table_name))
+
+        try:
+            return faiss.read_index(path)
+        except Exception as e:
+            print("Error in IndexRegistry.load: ", e)
+            return None
+
+    def put(self, table_name, index):
+        table_name = str(table_name)
+        path = self._get_path(table_name)
+
+        # Write to a temporary file first so a crash never leaves a truncated index behind
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        faiss.write_index(self._to_cpu(index), tmp_path)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self._insert(table_name, index, os.stat(path))
+
+    def invalidate(self, table_name):
+        table_name = str(table_name)
+
+        with self.lock:
+            self._remove(table_name)
+
+            path = self._get_path(table_name)
+            if os.path.isfile(path):
+                os.remove(path)
@@ -0,0 +1,267 @@
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .indexingpipeline import IndexingStats
+
+## Notes:
+# 1.) Long running work (encode / re-index) runs as a background job, the request only submits it and
+#     returns the job id. Jobs run on a small thread pool inside the server process.
+# 2.) Jobs are mirrored to the indexing_jobs table, so the status of a job can be read from any server
+#     worker, not only from the one running it. Progress of running jobs is saved every progress_interval.
+# 3.) A job is active while it is queued or running and its row was saved recently, so a job of a crashed
+#     worker stops blocking new jobs for the same project after a few intervals
+# 4.) The job manager has its own connection, access is serialized with a lock
+# 5.) Submitting checks for an active job and inserts the new one under an advisory lock on (kind, url), so two
+#     server workers receiving the same request start a single job
+
+
+class Job(object):
+    def __init__(self, kind, url):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.url = url
+        self.status = "queued"
+        self.flag = None
+        self.error = None
+        self.stats = IndexingStats()  # Progress counters, filled in by the job
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "url": self.url,
+            "status": self.status,
+            "flag": self.flag,
+            "error": self.error,
+            "files_parsed": self.stats.files_parsed,
+            "functions_embedded": self.stats.functions_embedded,
+            "rows_written": self.stats.rows_written,
+            "files_skipped": self.stats.files_skipped,
+            "bytes_skipped": self.stats.bytes_skipped,
+            "skipped": self.stats.skipped,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager(object):
+    def __init__(self, conn, num_workers, progress_interval):
+        self.conn = conn
+        self.progress_interval = progress_interval
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="job"
+        )
+        self.jobs = (
+            {}
+        )  # Unfinished jobs of this worker, finished jobs are only kept in the table
+        self.lock = threading.Lock()
+
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS indexing_jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT,
+                url TEXT,
+                status TEXT,
+                flag INT,
+                error TEXT,
+                files_parsed INT,
+                functions_embedded INT,
+                rows_written INT,
+                created_at DOUBLE PRECISION,
+                finished_at DOUBLE PRECISION,
+                updated_at TIMESTAMP DEFAULT NOW()
+            );
+            CREATE INDEX IF NOT EXISTS indexing_jobs_url ON indexing_jobs (url, kind);
+            ALTER TABLE indexing_jobs ADD COLUMN IF NOT EXISTS files_skipped INT;
+            ALTER TABLE indexing_jobs ADD COLUMN IF NOT EXISTS bytes_skipped BIGINT;
+            ALTER TABLE indexing_jobs ADD COLUMN IF NOT EXISTS skipped TEXT;
+            """
+        )
+        self.conn.commit()
+
+        threading.Thread(target=self._save_progress, daemon=True).start()
+
+    # Upserts the job's row, the caller holds self.lock and commits
+    def _write(self, cur, job):
+        job = job.to_dict()
+        job["skipped"] = json.dumps(job["skipped"])
+
+        cur.execute(
+            """
+                    INSERT INTO indexing_jobs (job_id, kind, url, status, flag, error, files_parsed,
+                        functions_embedded, rows_written, files_skipped, bytes_skipped, skipped, created_at,
+                        finished_at)
+                    VALUES (%(job_id)s, %(kind)s, %(url)s, %(status)s, %(flag)s, %(error)s, %(files_parsed)s,
+                        %(functions_embedded)s, %(rows_written)s, %(files_skipped)s, %(bytes_skipped)s,
+                        %(skipped)s, %(created_at)s, %(finished_at)s)
+                    ON CONFLICT (job_id) DO UPDATE SET status = EXCLUDED.status, flag = EXCLUDED.flag,
+                        error = EXCLUDED.error, files_parsed = EXCLUDED.files_parsed,
+                        functions_embedded = EXCLUDED.functions_embedded,
+                        rows_written = EXCLUDED.rows_written, files_skipped = EXCLUDED.files_skipped,
+                        bytes_skipped = EXCLUDED.bytes_skipped, skipped = EXCLUDED.skipped, finished_at = EXCLUDED.finished_at,
+                        updated_at = NOW();
+                    """,
+            job,
+        )
+
+    def _save(self, job):
+        with self.lock:
+            cur = self.conn.cursor()
+            try:
+                self._write(cur, job)
+                self.conn.commit()
+            except Exception as e:
+                print("Error in JobManager._save: ", e)
+                self.conn.rollback()
+
+    # Keeps the rows of unfinished jobs fresh, see note 3
+    def _save_progress(self):
+        while True:
+            time.sleep(self.progress_interval)
+
+            with self.lock:
+                jobs = list(self.jobs.values())
+
+            for job in jobs:
+                self._save(job)
+
+    def _run(self, job, target):
+        job.status = "running"
+        self._save(job)
+
+        try:
+            job.flag = target(job)
+            job.status = "done"
+        except Exception as e:
+            print("Error in JobManager._run: ", job.job_id, e)
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            job.stats.end_time = time.monotonic()
+            self._save(job)
+
+            with self.lock:
+                del self.jobs[job.job_id]
+
+    # Active job of this kind for the project, from any server worker. The caller holds self.lock and commits.
+    def _find_active(self, cur, kind, url):
+        for job in self.jobs.values():
+            if job.kind == kind and job.url == url:
+                return job.job_id
+
+        cur.execute(
+            """
+            SELECT job_id FROM indexing_jobs
+            WHERE kind = %s AND url = %s AND status IN ('queued', 'running')
+                AND updated_at > NOW() - %s * INTERVAL '1 second'
+            ORDER BY created_at DESC LIMIT 1;
+            """,
+            (kind, url, 3 * self.progress_interval),
+        )
+        rows = cur.fetchall()
+
+        return rows[0][0] if rows else None
+
+    # Returns the job id of an active job of this kind for the project, from any server worker
+    def get_active(self, kind, url):
+        with self.lock:
+            cur = self.conn.cursor()
+            try:
+                job_id = self._find_active(cur, kind, url)
+                self.conn.commit()
+            except Exception as e:
+                print("Error in JobManager.get_active: ", e)
+                self.conn.rollback()
+                job_id = None
+
+        return job_id
+
+    # target(job) runs on the job pool and returns the job's flag. Returns the job id, which is the id of
+    # the already active job when the same work is submitted twice (to this or another server worker: the
+    # check and the insert of the job's row hold an advisory lock on the kind and url until they commit).
+    def submit(self, kind, url, target):
+        with self.lock:
+            cur = self.conn.cursor()
+            try:
+                cur.execute(
+                    """SELECT pg_advisory_xact_lock(hashtext(%s))""",
+                    ("{}:{}".format(kind, url),),
+                )
+                job_id = self._find_active(cur, kind, url)
+
+                if job_id is None:
+                    job = Job(kind=kind, url=url)
+                    self._write(cur, job)
+
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+            if job_id is not None:
+                return job_id
+
+            self.jobs[job.job_id] = job
+
+        self.executor.submit(self._run, job, target)
+
+        return job.job_id
+
+    # Returns the job as a dict, None for unknown job ids
+    def get(self, job_id):
+        with self.lock:
+            if job_id in self.jobs:
+                return self.jobs[job_id].to_dict()
+
+            cur = self.conn.cursor()
+            try:
+                cur.execute(
+                    """
+                    SELECT job_id, kind, url, status, flag, error, files_parsed, functions_embedded,
+                        rows_written, files_skipped, bytes_skipped, skipped, created_at, finished_at
+                    FROM indexing_jobs WHERE job_id = %s;
+                    """,
+                    (job_id,),
+                )
+                rows = cur.fetchall()
+                self.conn.commit()
+            except Exception as e:
+                print("Error in JobManager.get: ", e)
+                self.conn.rollback()
+                rows = []
+
+        if not rows:
+            return None
+
+        job = dict(
+            zip(
+                [
+                    "job_id",
+                    "kind",
+                    "url",
+                    "status",
+                    "flag",
+                    "error",
+                    "files_parsed",
+                    "functions_embedded",
+                    "rows_written",
+                    "files_skipped",
+                    "bytes_skipped",
+                    "skipped",
+                    "created_at",
+                    "finished_at",
+                ],
+                rows[0],
+            )
+        )
+        job["skipped"] = json.loads(job["skipped"]) if job["skipped"] else {}
+
+        return job
@@ -0,0 +1,121 @@
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+## Notes:
+# 1.) BM25 inverted index over the functions of one project, built in-process from the embeddings table
+#   - the identifiers of the function source (stored in the tokens column at indexing time)
+#   - the function name and class name (counted name_weight times) and the file path
+# 2.) Identifiers are indexed whole and split into their snake_case / camelCase parts, so "parse_module"
+#     matches the exact identifier first and "parse module" still matches its parts
+# 3.) fuse() merges ranked id lists with reciprocal rank fusion, used for hybrid (lexical + vector) search
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+PART_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+# Identifiers of the source, in order (stored space separated in the tokens column)
+def get_identifiers(source):
+    return IDENTIFIER_PATTERN.findall(source)
+
+
+def tokenize(text):
+    tokens = []
+
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        parts = [part.lower() for part in PART_PATTERN.findall(identifier)]
+        tokens.extend(parts)
+
+        if len(parts) > 1:
+            tokens.append(identifier.lower())
+
+    return tokens
+
+
+# ranked_lists: lists of ids, best first. Returns the ids ordered by their fused score.
+def fuse(ranked_lists, k=60):
+    scores = {}
+
+    for ranked_list in ranked_lists:
+        for rank, id in enumerate(ranked_list):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank + 1)
+
+    return sorted(scores, key=lambda id: -scores[id])
+
+
+class LexicalIndex(object):
+    def __init__(self, ids, documents, k1=1.2, b=0.75):
+        self.ids = np.asarray(ids, dtype="int64")
+        self.k1 = k1
+        self.b = b
+
+        postings = {}
+        self.doc_lengths = np.zeros(len(documents), dtype="float32")
+
+        for doc, tokens in enumerate(documents):
+            self.doc_lengths[doc] = len(tokens)
+
+            for token, tf in Counter(tokens).items():
+                postings.setdefault(token, ([], []))
+                postings[token][0].append(doc)
+                postings[token][1].append(tf)
+
+        self.postings = {
+            token: (np.array(docs, dtype="int32"), np.array(tfs, dtype="float32"))
+            for token, (docs, tfs) in postings.items()
+        }
+        self.avg_doc_length = (
+            max(float(self.doc_lengths.mean()), 1.0) if len(documents) else 1.0
+        )
+
+    @classmethod
+    def load(cls, conn, table_name, name_weight=2):
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, function_name, class_name, filepath, tokens FROM embeddings_{};
+            """.format(
+                table_name
+            )
+        )
+
+        ids = []
+        documents = []
+        for id, function_name, class_name, filepath, tokens in cur.fetchall():
+            ids.append(id)
+            documents.append(
+                tokenize(tokens or "")
+                + tokenize(function_name or "") * name_weight
+                + tokenize(class_name or "") * name_weight
+                + tokenize(filepath or "")
+            )
+
+        return cls(ids=ids, documents=documents)
+
+    # Returns the ids of the top k functions for the query, best first. allowed_ids restricts the search.
+    def search(self, query, k, allowed_ids=None):
+        num_docs = len(self.ids)
+        scores = np.zeros(num_docs, dtype="float32")
+
+        for token in set(tokenize(query)):
+            if token not in self.postings:
+                continue
+
+            docs, tfs = self.postings[token]
+            idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (
+                1 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length
+            )
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        if allowed_ids is not None:
+            scores[~np.isin(self.ids, allowed_ids)] = 0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return [int(id) for id in self.ids[candidates]]
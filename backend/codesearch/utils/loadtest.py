@@ -0,0 +1,125 @@
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import numpy as np
+
+## Notes:
+# 1.) Load test of /search against a running server, with every indexed project (from GET /)
+# 2.) Correctness: the results of every (project, query) pair are first collected by a single client,
+#     then N parallel clients send random pairs and every response must match those results exactly
+#     (a race on shared handler state shows up as results of another project or query)
+# 3.) Throughput and latency percentiles are reported for each number of clients
+# 4.) Use model.embedding_provider: fake on the server for deterministic query embeddings without API calls
+
+QUERIES = [
+    "read a file and return its lines",
+    "parse command line arguments",
+    "connect to the database",
+    "sort a list of items by key",
+    "handle an http request",
+    "compute the hash of a string",
+    "retry a failed network call",
+    "convert json to a dictionary",
+]
+
+
+def _post(base_url, path, data):
+    request = urllib.request.Request(
+        base_url + path, data=urllib.parse.urlencode(data).encode("utf-8")
+    )
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return json.loads(response.read())
+
+
+def _get(base_url, path):
+    with urllib.request.urlopen(base_url + path, timeout=300) as response:
+        return json.loads(response.read())
+
+
+def _search(base_url, url, query):
+    return _post(base_url, "/search", {"url": url, "query": query})
+
+
+def _run_client(base_url, pairs, expected, num_requests, seed, results):
+    rng = random.Random(seed)
+
+    for _ in range(num_requests):
+        url, query = rng.choice(pairs)
+
+        start_time = time.perf_counter()
+        try:
+            result = _search(base_url, url, query)
+            error = False
+        except Exception as e:
+            print("Error in loadtest._run_client: ", e)
+            result = None
+            error = True
+        latency = time.perf_counter() - start_time
+
+        results.append((latency, error, result == expected[(url, query)]))
+
+
+def run(base_url, num_clients, num_requests):
+    projects = list(_get(base_url, "/").values())
+    if not projects:
+        print("No indexed projects, encode a few projects first")
+        return
+
+    pairs = [(url, query) for url in projects for query in QUERIES]
+    expected = {(url, query): _search(base_url, url, query) for url, query in pairs}
+    print(
+        "{} projects, {} queries, {} distinct searches".format(
+            len(projects), len(QUERIES), len(pairs)
+        )
+    )
+
+    for clients in sorted(set([1, num_clients])):
+        results = []
+        threads = [
+            threading.Thread(
+                target=_run_client,
+                args=(base_url, pairs, expected, num_requests, seed, results),
+            )
+            for seed in range(clients)
+        ]
+
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start_time
+
+        latencies = np.array([latency for latency, _, _ in results]) * 1000
+        num_errors = sum(1 for _, error, _ in results if error)
+        num_mismatches = sum(
+            1 for _, error, matching in results if not error and not matching
+        )
+
+        print(
+            "{} clients: {} requests, {} errors, {} mismatches, {:.1f} requests/sec, "
+            "latency p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(
+                clients,
+                len(results),
+                num_errors,
+                num_mismatches,
+                len(results) / elapsed,
+                np.percentile(latencies, 50),
+                np.percentile(latencies, 95),
+                np.percentile(latencies, 99),
+            )
+        )
+
+
+if __name__ == "__main__":
+    # Usage: python -m codesearch.utils.loadtest [base_url] [num_clients] [requests_per_client]
+    run(
+        base_url=sys.argv[1] if len(sys.argv) > 1 else "http://localhost:5000",
+        num_clients=int(sys.argv[2]) if len(sys.argv) > 2 else 16,
+        num_requests=int(sys.argv[3]) if len(sys.argv) > 3 else 50,
+    )
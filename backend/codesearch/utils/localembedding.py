@@ -0,0 +1,269 @@
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+import onnxruntime as ort
+from tokenizers import Tokenizer
+
+from .embeddingprovider import EmbeddingProvider
+
+## Notes:
+# 1.) Local embedding models run on CPU with ONNX Runtime and make no network calls. A model is a directory with
+#   - model.onnx: inputs input_ids, attention_mask (and token_type_ids if the model has them), first output
+#     the token embeddings of shape (batch, tokens, dimension), e.g. a code embedding model exported with
+#     `optimum-cli export onnx --task feature-extraction`
+#   - tokenizer.json: the HuggingFace tokenizer of the model
+# 2.) Selected with model.code_embedding: local:<model directory> (model.text_embedding must be the same model,
+#     queries are searched against the code embeddings). Settings are in the local_embedding section of config.yaml
+# 3.) Dynamic batching: the embed() calls of all threads go through one queue. The inference thread takes the
+#     waiting calls (waiting up to max_wait_ms for more), sorts their inputs by length and runs batches of at most
+#     max_batch_tokens padded tokens, so concurrent queries share one run and short inputs are not padded to the
+#     longest function
+# 4.) num_threads: ONNX Runtime intra-op threads, 0 uses one per core. With several server workers, set it so
+#     that workers * num_threads is about the number of cores
+# 5.) quantize: int8 quantizes the weights of the model once (dynamic quantization), the quantized model is
+#     written next to the original one as model.int8.onnx
+# 6.) Embeddings are mean (or CLS) pooled over the tokens and L2 normalized, like the OpenAI embeddings
+# 7.) provider.model is the model name with the settings that change the embeddings (quantize, pooling,
+#     max_length), e.g. local:/models/x?quantize=int8&pooling=mean&max_length=512. It keys the embedding and
+#     query caches and is recorded per project, so embeddings of different settings are never mixed.
+
+MAX_COALESCED_CALLS = 256
+
+
+class _EmbedCall(object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.done = threading.Event()
+        self.embeddings = None
+        self.error = None
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    def __init__(
+        self,
+        model,
+        model_dir,
+        num_threads=0,
+        quantize="none",
+        pooling="mean",
+        max_length=512,
+        max_batch_tokens=16384,
+        max_wait_ms=5,
+    ):
+        super().__init__(
+            "{}?quantize={}&pooling={}&max_length={}".format(
+                model, quantize, pooling, max_length
+            )
+        )
+        self.pooling = pooling
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.pad_id = (
+            self.tokenizer.token_to_id("[PAD]")
+            or self.tokenizer.token_to_id("<pad>")
+            or 0
+        )
+
+        model_path = os.path.join(model_dir, "model.onnx")
+        if quantize == "int8":
+            model_path = self._get_quantized_model(model_path)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = set(input.name for input in self.session.get_inputs())
+
+        self.dimension = self._run(self.tokenizer.encode_batch(["dimension"])).shape[1]
+
+        self.calls = []  # Batch size of every inference run
+        self.queue = queue.Queue()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _get_quantized_model(self, model_path):
+        quantized_path = model_path[: -len(".onnx")] + ".int8.onnx"
+
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            tmp_path = "{}.{}.tmp".format(quantized_path, os.getpid())
+            quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, quantized_path)
+
+        return quantized_path
+
+    # One inference run, encodings are padded to the longest one
+    def _run(self, encodings):
+        length = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.full((len(encodings), length), self.pad_id, dtype="int64")
+        attention_mask = np.zeros((len(encodings), length), dtype="int64")
+
+        for row, encoding in enumerate(encodings):
+            input_ids[row, : len(encoding.ids)] = encoding.ids
+            attention_mask[row, : len(encoding.ids)] = encoding.attention_mask
+
+        feed = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.zeros_like(input_ids)
+
+        token_embeddings = self.session.run(None, feed)[0]
+
+        if self.pooling == "cls":
+            embeddings = token_embeddings[:, 0]
+        else:
+            mask = np.expand_dims(attention_mask, axis=2).astype("float32")
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.maximum(
+                mask.sum(axis=1), 1
+            )
+
+        norms = np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+        return (embeddings / norms).astype("float32")
+
+    # Embeds the encodings in batches of inputs of similar length, rows are in the order of the encodings
+    def _embed_encodings(self, encodings):
+        embeddings = np.zeros((len(encodings), self.dimension), dtype="float32")
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i].ids))
+
+        batch = []
+        for i in order:
+            # Inputs come sorted by length, the padded size of the batch is the length of its last input
+            if (
+                batch
+                and (len(batch) + 1) * len(encodings[i].ids) > self.max_batch_tokens
+            ):
+                embeddings[batch] = self._run([encodings[j] for j in batch])
+                self.calls.append(len(batch))
+                batch = []
+            batch.append(i)
+
+        if batch:
+            embeddings[batch] = self._run([encodings[j] for j in batch])
+            self.calls.append(len(batch))
+
+        return embeddings
+
+    # Takes the next call and the calls arriving within max_wait, embeds all their inputs together
+    def _serve(self):
+        while True:
+            calls = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(calls) < MAX_COALESCED_CALLS:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        calls.append(self.queue.get(timeout=remaining))
+                    else:
+                        calls.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                inputs = [input for call in calls for input in call.inputs]
+                embeddings = self._embed_encodings(self.tokenizer.encode_batch(inputs))
+
+                start = 0
+                for call in calls:
+                    call.embeddings = embeddings[start : start + len(call.inputs)]
+                    start += len(call.inputs)
+            except Exception as e:
+                print("Error in LocalEmbeddingProvider._serve: ", e)
+                for call in calls:
+                    call.error = e
+
+            for call in calls:
+                call.done.set()
+
+    def embed(self, inputs):
+        if len(inputs) == 0:
+            return np.zeros((0, self.dimension), dtype="float32")
+
+        call = _EmbedCall(inputs=list(inputs))
+        self.queue.put(call)
+        call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.embeddings
+
+
+def benchmark(model_dir, source_dir, num_inputs, num_threads):
+    inputs = []
+    for root, dirs, files in os.walk(source_dir):
+        for file in files:
+            if file.endswith(".py") and len(inputs) < num_inputs:
+                with open(
+                    os.path.join(root, file), encoding="utf-8", errors="ignore"
+                ) as f:
+                    inputs.extend(f.read().split("\n\n\n"))
+    inputs = [input for input in inputs if input.strip()][:num_inputs]
+    print("{} inputs from {}".format(len(inputs), source_dir))
+
+    reference = None
+    for quantize in ["none", "int8"]:
+        provider = LocalEmbeddingProvider(
+            model="local:" + model_dir,
+            model_dir=model_dir,
+            num_threads=num_threads,
+            quantize=quantize,
+        )
+
+        start_time = time.perf_counter()
+        embeddings = provider.embed(inputs)
+        elapsed = time.perf_counter() - start_time
+        print(
+            "quantize {}: dimension {}, {:.1f} inputs/sec, {} inference runs".format(
+                quantize, provider.dimension, len(inputs) / elapsed, len(provider.calls)
+            )
+        )
+
+        if reference is None:
+            reference = embeddings
+        else:
+            print(
+                "  cosine similarity to the fp32 embeddings: mean {:.4f}, min {:.4f}".format(
+                    (embeddings * reference).sum(axis=1).mean(),
+                    (embeddings * reference).sum(axis=1).min(),
+                )
+            )
+
+        # Concurrent single-query calls, coalesced into shared inference runs
+        provider.calls.clear()
+        threads = [
+            threading.Thread(target=provider.embed, args=([input],))
+            for input in inputs[:64]
+        ]
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start_time
+        print(
+            "  {} concurrent queries: {:.1f} ms, {} inference runs".format(
+                len(threads), elapsed * 1000, len(provider.calls)
+            )
+        )
+
+
+if __name__ == "__main__":
+    # Usage: python -m codesearch.utils.localembedding <model_dir> [source_dir] [num_inputs] [num_threads]
+    benchmark(
+        model_dir=sys.argv[1],
+        source_dir=sys.argv[2] if len(sys.argv) > 2 else ".",
+        num_inputs=int(sys.argv[3]) if len(sys.argv) > 3 else 500,
+        num_threads=int(sys.argv[4]) if len(sys.argv) > 4 else 0,
+    )
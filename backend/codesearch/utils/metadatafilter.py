@@ -0,0 +1,132 @@
+import threading
+
+import faiss
+import numpy as np
+
+from .fileparser import get_language
+
+## Notes:
+# 1.) Filters restrict a search to rows of the embeddings table, they are applied inside index.search
+#     with a FAISS IDSelectorBitmap, so a filtered search still returns a full top-k
+#   - filepath: prefix of the stored filepath
+#   - class_name, function_name: exact match
+#   - language: language of the file (see fileparser.get_language)
+#   Several filters select the rows matching all of them
+# 2.) ProjectMetadata is loaded once per index from the embeddings table. Every column is stored as
+#     codes into its distinct values, so a filter is a comparison on an int array and only the distinct
+#     values (e.g. files, not functions) are matched in Python. Masks are cached per filter value.
+# 3.) The bitmap is indexed by the row ids, which IndexIDMap2 translates to its internal ids
+
+FILTER_FIELDS = ("filepath", "class_name", "function_name", "language")
+
+
+# Returns the filters set in `values` (a dict-like, e.g. request.form), an empty dict for none
+def get_filters(values):
+    return {
+        field: values[field]
+        for field in FILTER_FIELDS
+        if values.get(field) not in (None, "")
+    }
+
+
+class ProjectMetadata(object):
+    def __init__(self, ids, function_names, class_names, filepaths, max_cached=64):
+        self.ids = np.asarray(ids, dtype="int64")
+        self.max_cached = max_cached
+
+        self.values = {}
+        self.codes = {}
+        for field, column in [
+            ("function_name", function_names),
+            ("class_name", class_names),
+            ("filepath", filepaths),
+        ]:
+            values, codes = np.unique(
+                np.array(["" if value is None else value for value in column]),
+                return_inverse=True,
+            )
+            self.values[field] = values.tolist()
+            self.codes[field] = codes.astype("int32")
+
+        # Languages of the distinct files, coded like the other columns
+        languages = [get_language(filepath) for filepath in self.values["filepath"]]
+        self.values["language"] = sorted(set(languages), key=str)
+        language_codes = np.array(
+            [self.values["language"].index(language) for language in languages],
+            dtype="int32",
+        )
+        self.codes["language"] = (
+            language_codes[self.codes["filepath"]]
+            if len(language_codes) > 0
+            else np.zeros(0, dtype="int32")
+        )
+
+        self.masks = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, conn, table_name):
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, function_name, class_name, filepath FROM embeddings_{};
+            """.format(
+                table_name
+            )
+        )
+        rows = cur.fetchall()
+
+        return cls(
+            ids=[row[0] for row in rows],
+            function_names=[row[1] for row in rows],
+            class_names=[row[2] for row in rows],
+            filepaths=[row[3] for row in rows],
+        )
+
+    def _get_mask(self, field, value):
+        key = (field, value)
+
+        with self.lock:
+            if key in self.masks:
+                return self.masks[key]
+
+        if field == "filepath":
+            matching = [
+                code
+                for code, filepath in enumerate(self.values[field])
+                if filepath.startswith(value)
+            ]
+        else:
+            matching = [
+                code
+                for code, field_value in enumerate(self.values[field])
+                if field_value == value
+            ]
+
+        mask = np.isin(self.codes[field], matching)
+
+        with self.lock:
+            if len(self.masks) >= self.max_cached:
+                self.masks.clear()
+            self.masks[key] = mask
+
+        return mask
+
+    # Ids of the rows matching every filter
+    def get_ids(self, filters):
+        mask = np.ones(len(self.ids), dtype=bool)
+
+        for field, value in filters.items():
+            assert field in FILTER_FIELDS, "Unknown filter: {}".format(field)
+            mask &= self._get_mask(field, value)
+
+        return self.ids[mask]
+
+    # Returns (selector, bitmap) for the ids, the bitmap must be kept alive while the selector is used
+    def get_selector(self, ids):
+        num_bits = int(self.ids.max()) + 1 if len(self.ids) > 0 else 1
+        bits = np.zeros(num_bits, dtype=bool)
+        bits[ids] = True
+        bitmap = np.packbits(bits, bitorder="little")
+
+        return faiss.IDSelectorBitmap(num_bits, faiss.swig_ptr(bitmap)), bitmap
@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .embeddingcache import get_input_hash
+
+## Notes:
+# 1.) In-memory LRU cache of query embeddings keyed by (model, normalized query), entries expire after
+#     ttl seconds. Queries are normalized (whitespace collapsed, case kept since identifiers are case
+#     sensitive) before they are embedded, with or without the cache, so "parse JSON" and " parse  JSON"
+#     share one embedding.
+# 2.) With a store (the EmbeddingCache), misses are looked up there before calling the provider and new
+#     embeddings are written to it, so the cache survives restarts and is shared by the server workers.
+#     The store has its own size based eviction, the TTL only applies to the in-memory entries.
+# 3.) Hit counters are per process, see get_stats()
+
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+
+class QueryEmbeddingCache(object):
+    def __init__(self, max_entries, ttl, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+
+        self.entries = OrderedDict()  # (model, query) -> (embedding, expiry time)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def _insert(self, key, embedding):
+        self.entries[key] = (embedding, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # queries must be normalized, returns {query: embedding} for the queries found
+    def get_many(self, model, queries):
+        found = {}
+        now = time.monotonic()
+
+        with self.lock:
+            for query in queries:
+                key = (model, query)
+
+                if key in self.entries:
+                    embedding, expiry_time = self.entries[key]
+
+                    if expiry_time > now:
+                        self.entries.move_to_end(key)
+                        found[query] = embedding
+                        continue
+
+                    del self.entries[key]
+                    self.expired += 1
+
+        missing = [query for query in set(queries) if query not in found]
+
+        if self.store is not None and missing:
+            hashes = {get_input_hash(query): query for query in missing}
+            stored = self.store.get_many(model, list(hashes))
+
+            with self.lock:
+                for content_hash, embedding in stored.items():
+                    found[hashes[content_hash]] = embedding
+                    self._insert((model, hashes[content_hash]), embedding)
+
+                self.store_hits += len(stored)
+
+        with self.lock:
+            self.hits += len(set(queries)) - len(missing)
+            self.misses += len([query for query in missing if query not in found])
+
+        return found
+
+    # embeddings is a dict {normalized query: embedding}
+    def put_many(self, model, embeddings):
+        with self.lock:
+            for query, embedding in embeddings.items():
+                self._insert((model, query), embedding)
+
+        if self.store is not None:
+            self.store.put_many(
+                model,
+                {
+                    get_input_hash(query): embedding
+                    for query, embedding in embeddings.items()
+                },
+            )
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.store_hits + self.misses
+
+        return (self.hits + self.store_hits) / max(lookups, 1)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "hit_rate": self.get_hit_rate(),
+                "entries": len(self.entries),
+            }
+
+    def __str__(self):
+        return "hits: {}, store hits: {}, misses: {}, hit rate: {:.2f}, entries: {}".format(
+            self.hits,
+            self.store_hits,
+            self.misses,
+            self.get_hit_rate(),
+            len(self.entries),
+        )
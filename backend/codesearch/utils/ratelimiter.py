@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+
+## Notes:
+# 1.) Token bucket shared by all embedding workers, limiting both requests/min and tokens/min
+# 2.) On a 429 the allowed rate is halved and every worker pauses until the retry-after hint has passed,
+#     on success it slowly climbs back to the configured quota (AIMD)
+# 3.) A single request may ask for more tokens than the bucket holds, the bucket then goes into debt
+#     instead of blocking forever
+
+
+class TokenBucket(object):
+    def __init__(self, rate_per_minute, burst_seconds):
+        self.max_rate = rate_per_minute / 60.0
+        self.rate = self.max_rate
+        self.burst_seconds = burst_seconds
+        self.level = self.capacity
+        self.last_update = time.monotonic()
+
+    @property
+    def capacity(self):
+        return self.rate * self.burst_seconds
+
+    def refill(self, now):
+        self.level = min(
+            self.capacity, self.level + (now - self.last_update) * self.rate
+        )
+        self.last_update = now
+
+    # Seconds to wait before `amount` can be taken, 0 if it can be taken now
+    def get_wait_time(self, amount):
+        needed = min(amount, self.capacity)
+
+        if self.level >= needed:
+            return 0
+
+        return (needed - self.level) / self.rate
+
+
+class AdaptiveRateLimiter(object):
+    def __init__(
+        self,
+        requests_per_minute,
+        tokens_per_minute,
+        burst_seconds=1,
+        min_fraction=0.05,
+        increase_fraction=0.05,
+    ):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds)
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds)
+        self.min_fraction = min_fraction
+        self.increase_fraction = increase_fraction
+
+        self.blocked_until = 0
+        self.num_rate_limited = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+
+                wait_time = max(
+                    self.blocked_until - now,
+                    self.requests.get_wait_time(1),
+                    self.tokens.get_wait_time(tokens),
+                )
+
+                if wait_time <= 0:
+                    self.requests.level -= 1
+                    self.tokens.level -= tokens
+                    return
+
+            time.sleep(wait_time)
+
+    def on_success(self):
+        with self.lock:
+            for bucket in (self.requests, self.tokens):
+                bucket.rate = min(
+                    bucket.max_rate,
+                    bucket.rate + bucket.max_rate * self.increase_fraction,
+                )
+
+    def on_rate_limited(self, retry_after=None):
+        with self.lock:
+            self.num_rate_limited += 1
+
+            for bucket in (self.requests, self.tokens):
+                bucket.rate = max(bucket.max_rate * self.min_fraction, bucket.rate / 2)
+                bucket.level = min(bucket.level, bucket.capacity)
+
+            if retry_after is not None:
+                self.blocked_until = max(
+                    self.blocked_until, time.monotonic() + retry_after
+                )
+
+
+# Exponential backoff with full jitter, attempt starts at 0
+def get_backoff_time(attempt, base, cap):
+    return random.uniform(0, min(cap, base * (2**attempt)))
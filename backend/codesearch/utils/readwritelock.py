@@ -0,0 +1,46 @@
+import threading
+from contextlib import contextmanager
+
+## Notes:
+# 1.) Many readers or one writer. Writers are preferred: once a writer waits, new readers wait too,
+#     so a stream of searches can not starve an index update
+# 2.) Not reentrant, a thread holding the lock must not acquire it again
+
+
+class ReadWriteLock(object):
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writer or self.waiting_writers > 0:
+                self.condition.wait()
+            self.readers += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers > 0:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
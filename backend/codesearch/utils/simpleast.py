@@ -0,0 +1,69 @@
+import ast
+import sys
+
+## Notes:
+# 1.) Python fast path using the stdlib ast module, same output format as SimpleCST
+#   - line_number is the line of the "def" (as with SimpleCST), source starts at the first decorator
+#   - source is dedented by the indentation of the "def", so methods look the same as top-level functions
+# 2.) The tree is walked iteratively with the enclosing class carried down an explicit stack
+# 3.) set_module() raises SyntaxError on code that the running interpreter can not parse (e.g. Python 2),
+#     callers fall back to SimpleCST in that case (see fileparser)
+
+
+class SimpleAST(object):
+    def __init__(self):
+        self.func_list = []
+        self.module = None
+
+    def set_module(self, filepath):
+        with open(filepath, "r") as f:
+            source_code = f.read()
+
+        self.module = ast.parse(source_code, filename=filepath)
+        self.lines = source_code.split("\n")
+
+    def reset_func_name(self):
+        self.func_list = []
+
+    def _get_source_code(self, node):
+        start_line = min([node.lineno] + [d.lineno for d in node.decorator_list])
+        lines = self.lines[start_line - 1 : node.end_lineno]
+
+        # col_offset is in bytes, but only leading whitespace is removed
+        indent = node.col_offset
+        lines = [line[min(indent, len(line) - len(line.lstrip())) :] for line in lines]
+
+        return "\n".join(lines) + "\n"
+
+    def iter_functions(self):
+        stack = [(self.module, "No class")]
+
+        while stack:
+            node, class_name = stack.pop()
+
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                yield {
+                    "class_name": class_name,
+                    "func_name": node.name,
+                    "line_number": node.lineno,
+                    "source": self._get_source_code(node),
+                }
+            elif isinstance(node, ast.ClassDef):
+                class_name = node.name
+
+            # Reversed, so that functions are yielded in source order
+            stack.extend(
+                (child, class_name)
+                for child in reversed(list(ast.iter_child_nodes(node)))
+            )
+
+    def traverse_tree(self):
+        self.func_list.extend(self.iter_functions())
+
+
+if __name__ == "__main__":
+    # Usage: python -m codesearch.utils.simpleast file.py
+    simple_ast = SimpleAST()
+    simple_ast.set_module(filepath=sys.argv[1])
+    simple_ast.traverse_tree()
+    print(simple_ast.func_list)
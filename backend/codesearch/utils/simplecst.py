@@ -6,6 +6,8 @@ import libcst
 #   - func_name: The name of the function.
 #   - line_number: The line number of the function definition.
 #   - source: The source code of the function definition.
+# 2. iter_functions() walks the tree iteratively with an explicit stack and yields the functions one at a
+#    time. The enclosing class is carried down the stack, so only positions need to be resolved.
 
 
 class SimpleCST(libcst.CSTVisitor):
@@ -56,6 +58,26 @@ class SimpleCST(libcst.CSTVisitor):
                 }
             )
 
+    def iter_functions(self):
+        positions = self.wrapper.resolve(libcst.metadata.PositionProvider)
+        stack = [(self.wrapper.module, "No class")]
+
+        while stack:
+            node, class_name = stack.pop()
+
+            if isinstance(node, libcst.FunctionDef):
+                yield {
+                    "class_name": str(class_name),
+                    "func_name": str(node.name.value),
+                    "line_number": str(positions[node].start.line),
+                    "source": str(self.module.code_for_node(node)),
+                }
+            elif isinstance(node, libcst.ClassDef):
+                class_name = node.name.value
+
+            # Reversed, so that functions are yielded in source order
+            stack.extend((child, class_name) for child in reversed(node.children))
+
 
 if __name__ == "__main__":
     # with open("/home/foneme/Desktop/codesearch/temp_proj/temp.py", "r") as f:
@@ -1,7 +1,61 @@
+import os
+import sys
+import threading
+import time
+
 from tree_sitter import Language, Parser
 
 ## Notes:
 # 1.) We are only encoding function definitions
+# 2.) Function sources are sliced from the file bytes with node.start_byte / node.end_byte, so extraction
+#     is linear in the file size (tree-sitter positions are byte offsets, not character offsets)
+# 3.) iter_functions() walks the tree iteratively with a TreeCursor and yields the functions one at a time,
+#     so deeply nested code can not hit the recursion limit. traverse_tree() collects them into func_list.
+# 4.) The grammar library is built once per process (or at image build time, see Dockerfile) and the
+#     Language objects are shared. Parser objects are not thread-safe, so they are cached per thread.
+# 5.) Same records as SimpleAST / SimpleCST: class_name is "No class" outside classes, and a decorated Python
+#     function is recorded from its decorated_definition (line of the "def", source from the first decorator)
+
+LIBRARY_PATH = "codesearch/utils/treesitter/build/my-languages.so"
+GRAMMAR_PATHS = [
+    "codesearch/utils/treesitter/tree-sitter-go",
+    "codesearch/utils/treesitter/tree-sitter-javascript",
+    "codesearch/utils/treesitter/tree-sitter-python",
+]
+LANGUAGES = ["go", "javascript", "python"]
+
+_languages = {}
+_languages_lock = threading.Lock()
+_parsers = threading.local()
+
+
+def build_library():
+    # Without the grammar sources (e.g. a prebuilt image) the existing library is used as is
+    if all(os.path.isdir(path) for path in GRAMMAR_PATHS):
+        Language.build_library(LIBRARY_PATH, GRAMMAR_PATHS)
+
+
+def get_language(lang):
+    with _languages_lock:
+        if not _languages:
+            build_library()
+
+            for name in LANGUAGES:
+                _languages[name] = Language(LIBRARY_PATH, name)
+
+    return _languages[lang]
+
+
+def get_parser(lang):
+    if not hasattr(_parsers, "cache"):
+        _parsers.cache = {}
+
+    if lang not in _parsers.cache:
+        parser = Parser()
+        parser.set_language(get_language(lang))
+        _parsers.cache[lang] = parser
+
+    return _parsers.cache[lang]
 
 
 class SimpleTreeSitter(object):
@@ -9,148 +63,194 @@ class SimpleTreeSitter(object):
         self.func_list = []
         self.module = None
 
-        # Tree Sitter
-        _ = Language.build_library(
-            "codesearch/utils/treesitter/build/my-languages.so",
-            [
-                "codesearch/utils/treesitter/tree-sitter-go",
-                "codesearch/utils/treesitter/tree-sitter-javascript",
-                "codesearch/utils/treesitter/tree-sitter-python",
-            ],
-        )
-
-        self.GO_LANGUAGE = Language(
-            "codesearch/utils/treesitter/build/my-languages.so", "go"
-        )
-        self.JS_LANGUAGE = Language(
-            "codesearch/utils/treesitter/build/my-languages.so", "javascript"
-        )
-        self.PY_LANGUAGE = Language(
-            "codesearch/utils/treesitter/build/my-languages.so", "python"
-        )
-
     def set_module(self, path):
         with open(path) as f:
             source_code = f.read()
 
-        self.module = self.parser.parse(bytes(source_code, "utf-8"))
+        self.source_bytes = bytes(source_code, "utf-8")
+        self.module = self.parser.parse(self.source_bytes)
 
     def set_language(self, lang):
         self.lang = lang
-        self.parser = Parser()
-
-        if lang == "go":
-            self.parser.set_language(self.GO_LANGUAGE)
-        elif lang == "javascript":
-            self.parser.set_language(self.JS_LANGUAGE)
-        elif lang == "python":
-            self.parser.set_language(self.PY_LANGUAGE)
+        self.parser = get_parser(lang)
 
     def reset_func_name(self):
         self.func_list = []
 
-    def _get_class_name(self, node):
-        parent_node = node.parent
+    def _get_source_code(self, node):
+        return self.source_bytes[node.start_byte : node.end_byte].decode("utf-8")
 
+    def _get_function_record(self, node, class_name):
         # Python
         if self.lang == "python":
-            if parent_node.type == "module":
-                return "No Class"
-            elif parent_node.type == "class_definition":
-                return parent_node.child_by_field_name("name").text.decode("utf-8")
+            if node.type == "decorated_definition":
+                definition = node.child_by_field_name("definition")
+                if definition is None or definition.type != "function_definition":
+                    return None
+
+                return {
+                    "class_name": class_name,
+                    "func_name": self._get_source_code(
+                        node=definition.child_by_field_name("name")
+                    ),
+                    "line_number": definition.start_point[0] + 1,
+                    "source": self._get_source_code(node=node),
+                }
+            elif node.type == "function_definition":
+                # Recorded from its decorated_definition
+                if (
+                    node.parent is not None
+                    and node.parent.type == "decorated_definition"
+                ):
+                    return None
+
+                func_name = node.child_by_field_name("name")
+            else:
+                return None
         # Javascript
         elif self.lang == "javascript":
-            if parent_node.type == "program":
-                return "No Class"
-            elif parent_node.type == "class_declaration":
-                return parent_node.child_by_field_name("name").text.decode("utf-8")
+            if node.type == "function_declaration" or node.type == "method_definition":
+                func_name = node.child_by_field_name("name")
+            elif node.type == "expression_statement":
+                func_name = None
+            else:
+                return None
+        else:
+            return None
 
-        return self._get_class_name(node=parent_node)
+        return {
+            "class_name": class_name,
+            "func_name": "Anonymous"
+            if func_name is None
+            else self._get_source_code(node=func_name),
+            "line_number": node.start_point[0] + 1,
+            "source": self._get_source_code(node=node),
+        }
 
-    def _get_source_code(self, node):
-        # assert (
-        #     node.type == "function_definition"
-        # ), """Node type must be "function_definition" """
+    # Pre-order walk with a TreeCursor, yielding function records as they are found. The enclosing
+    # classes are kept on a stack of (depth, class name) instead of walking up the parents of every function.
+    def iter_functions(self, node=None):
+        if node is None:
+            node = self.module.root_node
 
-        start_row, start_column = node.start_point
-        end_row, end_column = node.end_point
+        class_type = (
+            "class_definition" if self.lang == "python" else "class_declaration"
+        )
+        cursor = node.walk()
+        depth = 0
+        classes = []
 
-        source_code = self.module.text.decode("utf-8")
-        lines = source_code.split("\n")
+        while True:
+            node = cursor.node
 
-        node_source_code_lines = lines[start_row : end_row + 1]
-        node_source_code_lines[0] = node_source_code_lines[0][start_column:]
-        node_source_code_lines[-1] = node_source_code_lines[-1][:end_column]
+            # Moving to a node at the same or a lower depth leaves the subtree of the classes above it
+            while classes and classes[-1][0] >= depth:
+                classes.pop()
 
-        node_source_code = "\n".join(node_source_code_lines)
+            record = self._get_function_record(
+                node=node, class_name=classes[-1][1] if classes else "No class"
+            )
+            if record is not None:
+                yield record
 
-        return node_source_code
+            if node.type == class_type:
+                classes.append(
+                    (depth, self._get_source_code(node.child_by_field_name("name")))
+                )
+
+            # Javascript: Ignoring a statement block, as it branches into the function definition
+            skip_children = node.type == "statement_block" and self.lang == "javascript"
+
+            if not skip_children and cursor.goto_first_child():
+                depth += 1
+                continue
+
+            while depth > 0 and not cursor.goto_next_sibling():
+                cursor.goto_parent()
+                depth -= 1
+
+            if depth == 0:
+                return
 
     def traverse_tree(self, node):
-        # Javascript: Ignoring a statement block, as it branches into the function definition
-        if node.type == "statement_block" and self.lang == "javascript":
-            return
+        self.func_list.extend(self.iter_functions(node=node))
 
-        # Python
-        if self.lang == "python":
-            if node.type == "function_definition":
-                class_name = self._get_class_name(node=node)
-                func_name = node.child_by_field_name("name").text.decode("utf-8")
-                source_code = self._get_source_code(node=node)
-
-                self.func_list.append(
-                    {
-                        "class_name": class_name,
-                        "func_name": func_name,
-                        "line_number": node.start_point[0] + 1,
-                        "source": source_code,
-                    }
-                )
-        # Javascript
-        elif self.lang == "javascript":
-            if node.type == "function_declaration" or node.type == "method_definition":
-                class_name = self._get_class_name(node=node)
-                func_name = node.child_by_field_name("name").text.decode("utf-8")
-                source_code = self._get_source_code(node=node)
-
-                self.func_list.append(
-                    {
-                        "class_name": class_name,
-                        "func_name": func_name,
-                        "line_number": node.start_point[0] + 1,
-                        "source": source_code,
-                    }
-                )
-            # Javascript
-            elif node.type == "expression_statement":
-                class_name = self._get_class_name(node=node)
-                # func_name = node.child_by_field_name("name").text.decode("utf-8")
-                source_code = self._get_source_code(node=node)
-
-                self.func_list.append(
-                    {
-                        "class_name": class_name,
-                        "func_name": "Anonymous",
-                        "line_number": node.start_point[0] + 1,
-                        "source": source_code,
-                    }
-                )
 
-        children = node.children
-        for child in children:
-            self.traverse_tree(child)
+# Per-file overhead of the old setup (build + load the grammars for every file) vs the shared registry
+def _benchmark_registry(path, num_files):
+    def parse_with_rebuild():
+        build_library()
+        parser = Parser()
+        parser.set_language(Language(LIBRARY_PATH, "javascript"))
+        _ = [Language(LIBRARY_PATH, name) for name in LANGUAGES]
 
+        sts = SimpleTreeSitter()
+        sts.lang = "javascript"
+        sts.parser = parser
+        sts.set_module(path=path)
+        sts.traverse_tree(sts.module.root_node)
+
+    def parse_with_registry():
+        sts = SimpleTreeSitter()
+        sts.set_language("javascript")
+        sts.set_module(path=path)
+        sts.traverse_tree(sts.module.root_node)
+
+    start_time = time.perf_counter()
+    get_language("javascript")
+    print(
+        "Startup (build + load): {:.1f} ms".format(
+            (time.perf_counter() - start_time) * 1000
+        )
+    )
+
+    for name, parse in [
+        ("rebuild", parse_with_rebuild),
+        ("registry", parse_with_registry),
+    ]:
+        start_time = time.perf_counter()
+        for _ in range(num_files):
+            parse()
+        elapsed = (time.perf_counter() - start_time) / num_files
+
+        print("{}: {:.3f} ms per file".format(name, elapsed * 1000))
 
-if __name__ == "__main__":
-    sts = SimpleTreeSitter()
-    # sts.set_language("python")
-    # sts.set_module(path="/home/foneme/Desktop/codesearch/temp_proj/temp.py")
-    # sts.traverse_tree(sts.module.root_node)
 
-    # print(sts.func_list)
+# Parse + extract time on generated bundles of growing size, the time per MB should stay flat
+def _benchmark_scaling(sizes_mb):
+    chunk = (
+        "class C {\n  m(a, b) {\n    return a + b;\n  }\n}\n"
+        "function f(x) {\n  return x * 2;\n}\n"
+        "console.log(f(1));\n"
+    )
 
-    sts.set_language("javascript")
-    sts.set_module(path="/home/foneme/Desktop/codesearch/temp_proj/temp.js")
-    sts.traverse_tree(sts.module.root_node)
+    for size_mb in sizes_mb:
+        path = "/tmp/simpletreesitter_benchmark.js"
+        with open(path, "w") as f:
+            f.write(chunk * int(size_mb * 1000000 / len(chunk)))
 
-    print(sts.func_list)
+        start_time = time.perf_counter()
+        sts = SimpleTreeSitter()
+        sts.set_language("javascript")
+        sts.set_module(path=path)
+        sts.traverse_tree(sts.module.root_node)
+        elapsed = time.perf_counter() - start_time
+
+        print(
+            "{} MB: {:.2f} s, {:.2f} s/MB, {} functions".format(
+                size_mb, elapsed, elapsed / size_mb, len(sts.func_list)
+            )
+        )
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    # Usage:
+    #   python -m codesearch.utils.simpletreesitter registry file.js [num_files]
+    #   python -m codesearch.utils.simpletreesitter scaling
+    if sys.argv[1] == "registry":
+        _benchmark_registry(
+            path=sys.argv[2], num_files=int(sys.argv[3]) if len(sys.argv) > 3 else 200
+        )
+    elif sys.argv[1] == "scaling":
+        _benchmark_scaling(sizes_mb=[0.25, 0.5, 1, 2, 4])
@@ -0,0 +1,21 @@
+import yaml
+
+## Notes:
+# 1.) Production server: gunicorn -c gunicorn.conf.py "main:create_app()"
+# 2.) Every worker process loads its own FlaskAPIHandler (the app is not preloaded, database connections
+#     must not be shared across a fork). The workers read and write the same persisted indexes in
+#     index.cache_dir, but each one keeps its own copies in memory, up to index.max_cache_bytes per worker.
+#     Only the inverted lists of IVF indexes are shared between the workers, with index.mmap: true.
+#     The embedding quota (indexing.requests_per_minute / tokens_per_minute) is split evenly between the workers.
+# 3.) Encode / re-index jobs run in the worker that received the request, the gthread worker keeps
+#     serving searches meanwhile. The timeout only applies to requests, not to background jobs.
+
+with open("./config.yaml", "r") as stream:
+    configs = yaml.safe_load(stream)
+
+bind = configs["server"]["bind"]
+workers = configs["server"]["workers"]
+worker_class = "gthread"
+threads = configs["server"]["threads"]
+timeout = configs["server"]["timeout"]
+preload_app = False
@@ -6,34 +6,95 @@ from flask_cors import CORS
 
 from codesearch.flaskapihandler import FlaskAPIHandler
 
-with open("./config.yaml", "r") as stream:
-    try:
-        configs = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        print("Error in reading config.yaml: ", exc)
-
-
 app = Flask(__name__)
 CORS(app)
-flask_api_handler = FlaskAPIHandler(configs=configs)
 
+# Built by create_app(), not at import time: parser processes re-import this module, and must not open
+# their own database pool, job manager and indexes
+flask_api_handler = None
 
-@app.route("/encode", methods=["POST"])
-def handle_encode():
-    flag = flask_api_handler.handle_encode(request=request)
 
-    assert (
-        flag == 0 or flag == 1 or flag == 2
-    ), "The return flag from FlaskAPIHandler.handle_encode should be either 0, 1, 2"
+# Production: gunicorn -c gunicorn.conf.py "main:create_app()"
+def create_app():
+    global flask_api_handler
+
+    with open("./config.yaml", "r") as stream:
+        try:
+            configs = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            print("Error in reading config.yaml: ", exc)
+
+    flask_api_handler = FlaskAPIHandler(configs=configs)
 
+    return app
+
+
+def get_encode_message(flag):
     if flag == 0:
         return "Repository Already Encoded"
     elif flag == 1:
         return "Encoding Complete"
     elif flag == 2:
         return "Incorrect Input"
-    else:  # flag == 3
+    elif flag == 3:
         return "Repo Larger than 100MB"
+    else:  # flag == 4
+        return "Encoding Failed"
+
+
+def get_reindex_message(flag):
+    if flag == 0:
+        return "Re-indexing Complete"
+    elif flag == 1:
+        return "Incorrect Input"
+    elif flag == 2:
+        return "Repo Larger than 100MB"
+    elif flag == 5:
+        return "Embedding Model Changed, Delete and Encode the Repository Again"
+    else:  # flag == 3
+        return "Re-indexing Failed"
+
+
+# Encoding runs as a background job, a started job is answered with 202 and its status (see /jobs)
+@app.route("/encode", methods=["POST"])
+def handle_encode():
+    flag, job_id = flask_api_handler.handle_encode(request=request)
+
+    assert (
+        flag == 0 or flag == 2 or flag == 5
+    ), "The return flag from FlaskAPIHandler.handle_encode should be either 0, 2, 5"
+
+    if flag == 5:
+        return jsonify(flask_api_handler.handle_job_status(job_id)), 202
+
+    return get_encode_message(flag)
+
+
+@app.route("/reindex", methods=["POST"])
+def handle_reindex():
+    flag, job_id = flask_api_handler.handle_reindex(request=request)
+
+    if flag == 4:
+        return jsonify(flask_api_handler.handle_job_status(job_id)), 202
+
+    return get_reindex_message(flag)
+
+
+# Status and progress of an encode / re-index job, "message" is set once the job is done
+@app.route("/jobs/<job_id>", methods=["GET"])
+def handle_job_status(job_id):
+    job = flask_api_handler.handle_job_status(job_id)
+
+    if job is None:
+        return "Job Not Found", 404
+
+    if job["flag"] is not None:
+        if job["kind"] == "encode":
+            job["message"] = get_encode_message(job["flag"])
+        else:
+            job["message"] = get_reindex_message(job["flag"])
+
+    return jsonify(job)
 
 
 @app.route("/search", methods=["GET", "POST"])
@@ -42,6 +103,25 @@ def handle_search():
     return jsonify(result_dict)
 
 
+# Per-query results of many queries, against one or more projects (see FlaskAPIHandler.handle_batch_search)
+@app.route("/search/batch", methods=["POST"])
+def handle_batch_search():
+    flag, results = flask_api_handler.handle_batch_search(request=request)
+
+    if flag == 0:
+        return jsonify(results)
+    elif flag == 1:
+        return "Incorrect Input"
+    else:  # flag == 2
+        return "Too Many Queries"
+
+
+# Search over every indexed project, results are tagged with the project URL
+@app.route("/search/global", methods=["POST"])
+def handle_global_search():
+    return jsonify(flask_api_handler.handle_global_search(request=request))
+
+
 @app.route("/delete", methods=["DELETE"])
 def handle_delete():
     flag = flask_api_handler.handle_delete(request=request)
@@ -52,12 +132,30 @@ def handle_delete():
         return "Error in Deletion"
 
 
+@app.route("/index/report", methods=["GET", "POST"])
+def handle_index_report():
+    report = flask_api_handler.handle_index_report(request=request)
+    return jsonify(report)
+
+
+@app.route("/index/memory", methods=["GET", "POST"])
+def handle_index_memory_report():
+    report = flask_api_handler.handle_index_memory_report(request=request)
+    return jsonify(report)
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    return jsonify(flask_api_handler.handle_metrics())
+
+
 @app.route("/", methods=["GET"])
 def handle_root():
     flag, project_data = flask_api_handler.handle_root()
     return jsonify(project_data)
 
 
+# Development server, in production the app is served by gunicorn (see gunicorn.conf.py)
 if __name__ == "__main__":
     print("App running on host 0.0.0.0 at port 5000")
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    create_app().run(debug=True, host="0.0.0.0", port=5000, use_reloader=False)
@@ -166,7 +166,34 @@ export default function SearchPage() {
       headers: { "Content-Type": "text/html; charset=utf-8" },
     })
       .then(function (response) {
+        // 202: the project is encoded by a background job
+        if (response.status == 202) {
+          pollJob(response.data.job_id);
+        } else {
+          setLoadingbar(false);
+        }
+      })
+      .catch(function (response) {
+        console.log(response);
         setLoadingbar(false);
+      });
+  };
+
+  const pollJob = (jobID) => {
+    axios({
+      method: "get",
+      url: `http://${baseURL}:5000/jobs/${jobID}`,
+      headers: { "Content-Type": "text/html; charset=utf-8" },
+    })
+      .then(function (response) {
+        var status = response.data.status;
+
+        if (status == "queued" || status == "running") {
+          setTimeout(() => pollJob(jobID), 2000);
+        } else {
+          setLoadingbar(false);
+          getProjects();
+        }
       })
       .catch(function (response) {
         console.log(response);